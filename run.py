@@ -11,6 +11,7 @@ from utils.baselines.detectGPT import detectGPT
 from utils.baselines.run_baselines import run_baselines
 from utils.setting import set_experiment_config, initial_setup
 from utils.load_models_tokenizers import load_base_model_and_tokenizer, load_base_model, load_mask_filling_model
+from utils.mask_filling import release_mask_filler
 
 
 # ====================== 核心：内置200条文本数据（修复samples键） ======================
@@ -352,6 +353,16 @@ def parse_args():
     parser.add_argument('--dataset_key', type=str, default='prompt', help='兼容原参数，无实际作用')
     parser.add_argument('--max_raw_data', type=int, default=500, help='加载的内置样本数（最大500）')
     parser.add_argument('--batch_size', type=int, default=8, help='批次大小')
+    parser.add_argument('--half', action='store_true', help='基础/掩码模型权重以半精度存储（fp32计算）')
+    parser.add_argument('--half_dtype', type=str, default='float16', choices=['float16', 'bfloat16'],
+                        help='--half 使用的半精度类型')
+    parser.add_argument('--int8', action='store_true', help='Linear层（含lm_head）逐通道int8量化')
+    parser.add_argument('--precision_reference', action='store_true',
+                        help='低精度模式下保留fp32参考模型，报告似然基线的AUC变化（需额外内存）')
+    parser.add_argument('--seq_chunk_size', type=int, default=128,
+                        help='分块计算对数似然时序列方向的块大小')
+    parser.add_argument('--vocab_chunk_size', type=int, default=8192,
+                        help='分块计算对数似然时词表方向的块大小（峰值内存与词表大小无关）')
     parser.add_argument('--n_perturbation_list', type=str, default='5,10',
                         help='扰动轮数列表（逗号分隔，如"3,5,7"）')
     # 模型配置
@@ -361,6 +372,15 @@ def parse_args():
                         help='掩码填充模型名称 (t5-small, t5-base, t5-large)')
     parser.add_argument('--scoring_model_name', type=str, default='', help='评分模型名称（为空则使用基础模型）')
     parser.add_argument('--cache_dir', type=str, default='./cache', help='模型缓存目录')
+    parser.add_argument('--model_memory_budget', type=float, default=4096,
+                        help='常驻模型注册表的内存预算（MB），超出时淘汰最久未使用的模型')
+    parser.add_argument('--weight_store', action='store_true',
+                        help='模型权重使用cache_dir下的内存映射权重文件（不存在时写入当前权重）')
+    parser.add_argument('--no_ll_cache', action='store_true', help='关闭对数似然缓存（默认缓存到cache_dir）')
+    parser.add_argument('--ll_cache_size', type=int, default=100000, help='对数似然缓存的内存LRU条目上限')
+    parser.add_argument('--token_cache_mb', type=float, default=256,
+                        help='分词缓存的内存上限（MB，0 表示关闭）')
+    parser.add_argument('--no_perturbation_bank', action='store_true', help='关闭持久化扰动库（默认保存到cache_dir）')
     parser.add_argument('--openai_model', type=str, default='', help='OpenAI模型名称（为空则使用本地模型）')
     # 生成配置
     parser.add_argument('--temperature', type=float, default=0.7, help='生成温度')
@@ -372,9 +392,34 @@ def parse_args():
                         help='掩码跨度长度 (1-3, 默认1已极致优化)')
     parser.add_argument('--n_perturbation_rounds', type=int, default=15,
                         help='扰动轮数 (10-25, 默认15已极致优化)')
+    parser.add_argument('--perturbation_seed', type=int, default=0,
+                        help='扰动种子（扰动库的键之一，更换种子即生成一组新的扰动）')
+    parser.add_argument('--detection_method', type=str, default='perturbation',
+                        choices=['perturbation', 'sampling_discrepancy'],
+                        help='曲率估计方法：perturbation（掩码扰动）或 sampling_discrepancy（单次前向解析估计，无需掩码模型）')
+    # 扰动流水线（多进程生成扰动，主进程计算似然）
+    parser.add_argument('--perturbation_workers', type=int, default=0,
+                        help='扰动进程数（各自持有掩码模型，与似然计算流水并行；0 表示在主进程中交替计算）')
+    parser.add_argument('--perturbation_queue_size', type=int, default=0,
+                        help='扰动流水线的在途批次上限（反压；0 表示 2 倍进程数）')
+    # 自适应扰动（逐文本提前停止）
+    parser.add_argument('--adaptive_rounds', action='store_true',
+                        help='启用自适应扰动：曲率估计收敛或已能判定阈值侧时提前停止')
+    parser.add_argument('--min_rounds', type=int, default=3, help='自适应扰动的最少轮数（至少2）')
+    parser.add_argument('--max_rounds', type=int, default=None,
+                        help='自适应扰动的最多轮数（默认取评分器的扰动数：DetectGPT 扫描为 --n_perturbation_list '
+                             '中的最大值，基线实验与级联实验为 --n_perturbation_rounds）')
+    parser.add_argument('--se_tolerance', type=float, default=0.01,
+                        help='自适应扰动：曲率标准误低于该值即停止')
+    parser.add_argument('--curvature_threshold', type=float, default=None,
+                        help='自适应扰动：序贯检验的曲率阈值（不设置则只按标准误停止）')
     # 实验配置
     parser.add_argument('--DEVICE', type=str, default='auto', choices=['auto', 'cpu', 'gpu'], help='Jittor设备配置')
     parser.add_argument('--skip_baselines', action='store_true', help='是否跳过基线模型')
+    parser.add_argument('--cascade', action='store_true',
+                        help='启用级联检测：似然分数先判定置信文本，仅不确定文本计算扰动曲率')
+    parser.add_argument('--cascade_escalation', type=float, default=0.3,
+                        help='级联检测中升级到扰动评分的文本比例（0~1）')
     parser.add_argument('--baselines_only', action='store_true', help='是否仅运行基线模型')
     parser.add_argument('--output_dir', type=str, default='./tmp_results', help='结果输出目录')
     parser.add_argument('--debug', action='store_true', help='启用调试模式')
@@ -423,7 +468,11 @@ if __name__ == "__main__":
         set_experiment_config(args, config)
         # 加载模型
         load_base_model_and_tokenizer(args, config, None)
-        load_mask_filling_model(args, config)
+        # 扰动进程池启用时掩码模型由各扰动进程加载与预热，主进程不加载；
+        # sampling_discrepancy 不需要掩码模型（级联实验用到时由扰动评分器按需加载）
+        if not args.perturbation_workers and args.detection_method == 'perturbation':
+            load_mask_filling_model(args, config)
+            config["mask_filler"].warm_up()
         load_base_model(args, config)
 
         # ====================== 核心：加载内置数据 ======================
@@ -463,12 +512,7 @@ if __name__ == "__main__":
             if not args.skip_baselines and "base_model" in config:
                 print("\n🚀 开始运行基线模型...")
                 baseline_outputs = run_baselines(args, config, data)
-            # 释放基础模型内存
-            if "base_model" in config:
-                del config["base_model"]
-            if "base_tokenizer" in config:
-                del config["base_tokenizer"]
-            # 加载评分模型
+            # 切换到评分模型（基础模型仍常驻模型注册表，超出 --model_memory_budget 时才淘汰）
             load_base_model_and_tokenizer(args, config, args.scoring_model_name)
             load_base_model(args, config)
         else:
@@ -477,7 +521,9 @@ if __name__ == "__main__":
                 baseline_outputs = run_baselines(args, config, data)
 
         # 运行DetectGPT
-        if not args.baselines_only and "base_model" in config:
+        if args.cascade and not args.baselines_only:
+            print("⏭️ 级联模式：扰动曲率已由级联实验按需计算，跳过对全部文本的DetectGPT扰动")
+        elif not args.baselines_only and "base_model" in config:
             print("\n🚀 开始运行DetectGPT...")
             outputs = detectGPT(args, config, data, args.span_length)
 
@@ -504,6 +550,22 @@ if __name__ == "__main__":
             roberta_result = run_roberta_baseline(args, config, data)
             if roberta_result:
                 outputs.append(roberta_result)  # 合并 RoBERTa 结果
+
+        # 报告对数似然缓存与扰动库复用情况
+        if config.get("ll_cache") is not None:
+            config["ll_cache"].report()
+            config["ll_cache"].close()
+        if config.get("perturbation_bank") is not None:
+            config["perturbation_bank"].report()
+        if config.get("model_registry") is not None:
+            config["model_registry"].report()
+        if config.get("token_cache") is not None:
+            config["token_cache"].report()
+        if config.get("perturbation_pool") is not None:
+            config["perturbation_pool"].report()
+            config["perturbation_pool"].close()
+        release_mask_filler(registry=config.get("model_registry"))
+
         # 保存结果
         if not baseline_outputs:
             print("⚠️ 无基线结果，创建空结果文件")
@@ -0,0 +1,6 @@
+# conftest.py
+# 测试从仓库根目录导入 utils 包（与 run.py 的运行方式一致）
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,123 @@
+# test_cache.py
+# 似然缓存与扰动库：落盘后重新打开可读回，键中任一组成部分变化即不再命中
+import json
+
+import numpy as np
+import jittor as jt
+
+from utils.cache import LLCache, PerturbationBank, TokenCache, model_fingerprint
+
+
+class _Tokenizer:
+    name_or_path = "dummy"
+
+
+def test_ll_cache_round_trip(tmp_path):
+    namespace = LLCache.namespace("gpt2", "abc", _Tokenizer(), 512)
+    keys = [LLCache.make_key(namespace, text) for text in ("a", "b")]
+
+    cache = LLCache(str(tmp_path))
+    assert cache.get_many(keys) == {}
+    cache.put_many({keys[0]: -1.5, keys[1]: -2.25})
+    assert cache.get_many(keys) == {keys[0]: -1.5, keys[1]: -2.25}
+    cache.close()
+
+    reopened = LLCache(str(tmp_path))
+    assert reopened.get_many(keys) == {keys[0]: -1.5, keys[1]: -2.25}
+    assert reopened.disk_hits == 2
+    assert reopened.stats()["misses"] == 0
+    reopened.close()
+
+
+def test_ll_cache_key_invalidation(tmp_path):
+    cache = LLCache(str(tmp_path))
+    tokenizer = _Tokenizer()
+    key = LLCache.make_key(LLCache.namespace("gpt2", "abc", tokenizer, 512), "text")
+    cache.put_many({key: -3.0})
+
+    # 权重指纹、模型名称、截断长度、文本任一不同都不命中
+    for other in (
+        LLCache.make_key(LLCache.namespace("gpt2", "def", tokenizer, 512), "text"),
+        LLCache.make_key(LLCache.namespace("gpt2-medium", "abc", tokenizer, 512), "text"),
+        LLCache.make_key(LLCache.namespace("gpt2", "abc", tokenizer, 256), "text"),
+        LLCache.make_key(LLCache.namespace("gpt2", "abc", tokenizer, 512), "text!"),
+    ):
+        assert cache.get_many([other]) == {}
+    assert cache.get_many([key]) == {key: -3.0}
+    cache.close()
+
+
+def test_ll_cache_lru_eviction():
+    cache = LLCache(max_entries=2)
+    cache.put_many({"a": 1.0, "b": 2.0})
+    cache.get_many(["a"])
+    cache.put_many({"c": 3.0})
+    assert set(cache.memory) == {"a", "c"}
+
+
+def test_model_fingerprint_tracks_weights():
+    jt.set_seed(0)
+    first = jt.nn.Linear(4, 3)
+    second = jt.nn.Linear(4, 3)
+    assert model_fingerprint(first) == model_fingerprint(first)
+    assert model_fingerprint(first) != model_fingerprint(second)
+
+
+def test_perturbation_bank_round_trip(tmp_path):
+    namespace = PerturbationBank.namespace("t5-small", "abc", "fp32", 0.3, 2, 0)
+    key = PerturbationBank.make_key(namespace, "original")
+
+    bank = PerturbationBank(str(tmp_path))
+    bank.append(key, 0, ["p0", "p1"])
+    bank.append(key, 3, ["p3"])  # 序号2缺失：前缀到1为止
+    assert bank.get_prefix(key, 5) == ["p0", "p1"]
+    assert bank.generated == 3
+
+    # 中断写入留下的残行被跳过
+    with open(bank.path, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"key": key, "index": 2, "text": "p2"}) + "\n")
+        f.write('{"key": "broken')
+
+    reopened = PerturbationBank(str(tmp_path))
+    assert reopened.get_prefix(key, 3) == ["p0", "p1", "p2"]
+    assert reopened.get_prefix(key, 10) == ["p0", "p1", "p2", "p3"]
+    assert reopened.reused == 7
+
+
+def test_perturbation_bank_key_invalidation(tmp_path):
+    bank = PerturbationBank(str(tmp_path))
+    base = ("t5-small", "abc", "fp32", 0.3, 2, 0)
+    bank.append(PerturbationBank.make_key(PerturbationBank.namespace(*base), "text"), 0, ["p0"])
+
+    # 掩码模型、权重指纹、精度、掩码比例、跨度、种子任一不同都取不到已有扰动
+    for position, value in enumerate(("t5-base", "def", "fp16", 0.15, 1, 1)):
+        params = list(base)
+        params[position] = value
+        assert bank.get_prefix(PerturbationBank.make_key(PerturbationBank.namespace(*params), "text"), 1) == []
+
+
+def test_perturbation_bank_counts_only_new_reuse(tmp_path):
+    bank = PerturbationBank(str(tmp_path))
+    key = PerturbationBank.make_key(PerturbationBank.namespace("t5-small", "abc", "fp32", 0.3, 2, 0), "text")
+    bank.append(key, 0, ["p0", "p1", "p2"])
+    # 逐轮扩展时重复查询：调用方已持有的条目不重复计入复用数
+    for n_rounds in (1, 2, 3):
+        bank.get_prefix(key, n_rounds, known=n_rounds - 1)
+    assert bank.reused == 3
+
+
+def test_token_cache_encodes_once():
+    calls = []
+
+    def encode(texts):
+        calls.append(list(texts))
+        return [[len(text), 1] for text in texts]
+
+    cache = TokenCache()
+    tokenizer = _Tokenizer()
+    first = cache.encode_many(tokenizer, ["ab", "abc", "ab"], 512, encode)
+    second = cache.encode_many(tokenizer, ["abc"], 512, encode)
+    assert calls == [["ab", "abc"]]
+    np.testing.assert_array_equal(first[2], [2, 1])
+    np.testing.assert_array_equal(second[0], [3, 1])
+    assert not first[0].flags.writeable
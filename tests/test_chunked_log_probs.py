@@ -0,0 +1,69 @@
+# test_chunked_log_probs.py
+# 分块计算的逐token统计与完整词表 log-softmax 的结果一致
+import numpy as np
+import jittor as jt
+import pytest
+
+from utils.baselines.model import (
+    chunked_token_log_probs, chunked_token_statistics, _batch_lls, _pad_batch
+)
+
+
+class TinyLM(jt.Module):
+    """最小语言模型：嵌入层 + lm_head，提供分块路径需要的 hidden_states / lm_head"""
+
+    def __init__(self, vocab_size=37, hidden_size=8):
+        self.embedding = jt.nn.Embedding(vocab_size, hidden_size)
+        self.lm_head = jt.nn.Linear(hidden_size, vocab_size)
+
+    def hidden_states(self, input_ids):
+        return self.embedding(input_ids)
+
+    def execute(self, input_ids):
+        return {"logits": self.lm_head(self.embedding(input_ids))}
+
+
+@pytest.fixture(scope="module")
+def batch():
+    jt.set_seed(0)
+    model = TinyLM()
+    rng = np.random.RandomState(0)
+    sequences = [rng.randint(1, 37, size=n).tolist() for n in (5, 11, 23)]
+    input_ids, attention_mask = _pad_batch(sequences, pad_token_id=0, pad_multiple=1)
+
+    with jt.no_grad():
+        logits = model(jt.array(input_ids))["logits"][:, :-1, :]
+        log_probs = jt.nn.log_softmax(logits, dim=-1).numpy().astype(np.float64)
+        logits = logits.numpy().astype(np.float64)
+    labels = input_ids[:, 1:]
+    reference = {
+        "token_ll": np.take_along_axis(log_probs, labels[..., None], axis=-1)[..., 0],
+        "expected_ll": (np.exp(log_probs) * log_probs).sum(-1),
+        "rank": (logits > np.take_along_axis(logits, labels[..., None], axis=-1)).sum(-1) + 1,
+    }
+    reference["var_ll"] = (np.exp(log_probs) * log_probs ** 2).sum(-1) - reference["expected_ll"] ** 2
+    return model, input_ids, attention_mask, reference
+
+
+@pytest.mark.parametrize("seq_chunk,vocab_chunk", [(1, 1), (3, 5), (4, 36), (128, 8192)])
+def test_chunked_statistics_match_full_softmax(batch, seq_chunk, vocab_chunk):
+    model, input_ids, _, reference = batch
+    stats = chunked_token_statistics(model, input_ids, seq_chunk, vocab_chunk, moments=True, ranks=True)
+
+    np.testing.assert_allclose(stats["token_ll"], reference["token_ll"], atol=1e-4)
+    np.testing.assert_allclose(stats["expected_ll"], reference["expected_ll"], atol=1e-4)
+    np.testing.assert_allclose(stats["var_ll"], reference["var_ll"], atol=1e-3)
+    np.testing.assert_array_equal(stats["rank"], reference["rank"])
+
+
+def test_chunked_log_probs_mask_padding(batch):
+    model, input_ids, attention_mask, reference = batch
+    token_ll, sequence_ll = chunked_token_log_probs(model, input_ids, attention_mask, seq_chunk=3, vocab_chunk=5)
+
+    loss_mask = attention_mask[:, 1:]
+    assert np.all(token_ll[loss_mask == 0] == 0)
+    expected = (reference["token_ll"] * loss_mask).sum(1) / loss_mask.sum(1)
+    np.testing.assert_allclose(sequence_ll, expected, atol=1e-4)
+    # 分块路径与完整logits路径给出相同的平均似然
+    np.testing.assert_allclose(_batch_lls(model, input_ids, attention_mask, 3, 5),
+                               _batch_lls(model, input_ids, attention_mask), atol=1e-4)
@@ -0,0 +1,67 @@
+# test_generate.py
+# 增量生成：每行在自己的停止token（或eos）处停止，其余位置填pad，输出截到最长一行停止处
+import numpy as np
+import jittor as jt
+
+from utils.load_models_tokenizers import T5ForConditionalGeneration
+
+VOCAB_SIZE = 10
+
+
+class CopyT5(T5ForConditionalGeneration):
+    """第 t 步输出输入的第 t 个token：编码器输出为输入的one-hot，解码器与 lm_head 直接透传"""
+
+    def __init__(self):
+        pass
+
+    def encode(self, input_ids):
+        return jt.array(np.eye(VOCAB_SIZE, dtype=np.float32)[input_ids.numpy()])
+
+    def decode_step(self, token_ids, encoder_states):
+        return encoder_states
+
+    def lm_head(self, hidden):
+        return hidden
+
+
+def test_generate_stops_per_row():
+    input_ids = np.array([
+        [5, 6, 3, 7, 8, 9],  # 停止token 3
+        [4, 2, 9, 9, 9, 9],  # eos 2
+        [7, 3, 8, 1, 6, 5],  # 停止token 8（出现在3之后）
+    ])
+    outputs = CopyT5().generate(
+        input_ids, max_length=6, pad_token_id=0, eos_token_id=2, stop_token_ids=[3, 5, 8]
+    ).numpy()
+
+    np.testing.assert_array_equal(outputs, [
+        [5, 6, 3],
+        [4, 2, 0],
+        [7, 3, 8],
+    ])
+
+
+def test_generate_without_stop_runs_to_max_length():
+    input_ids = np.array([[5, 6, 7, 8], [9, 1, 4, 6]])
+    outputs = CopyT5().generate(input_ids, max_length=3, pad_token_id=0).numpy()
+    np.testing.assert_array_equal(outputs, input_ids[:, :3])
+
+
+def test_generate_pads_beyond_encoder_length():
+    # 解码步数超过编码器长度时编码器输出视为0，argmax 落到0号token
+    outputs = CopyT5().generate(np.array([[5, 6]]), max_length=4, pad_token_id=0).numpy()
+    np.testing.assert_array_equal(outputs, [[5, 6, 0, 0]])
+
+
+class ShiftedCopyT5(CopyT5):
+    """输出 (输入token - 1) mod 词表大小：pad(0) 若未被置0会输出 9"""
+
+    def encode(self, input_ids):
+        return jt.array(np.eye(VOCAB_SIZE, dtype=np.float32)[(input_ids.numpy() + VOCAB_SIZE - 1) % VOCAB_SIZE])
+
+
+def test_generate_ignores_batch_padding():
+    alone = ShiftedCopyT5().generate(np.array([[5, 6]]), max_length=4, pad_token_id=0).numpy()
+    batch = ShiftedCopyT5().generate(np.array([[5, 6, 0, 0], [5, 6, 7, 8]]), max_length=4, pad_token_id=0).numpy()
+    np.testing.assert_array_equal(alone, [[4, 5, 0, 0]])
+    np.testing.assert_array_equal(batch[0], alone[0])
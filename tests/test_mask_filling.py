@@ -0,0 +1,55 @@
+# test_mask_filling.py
+# 掩码采样：掩码token数、跨度不重叠、与同批其他文本无关、可复现
+import numpy as np
+import pytest
+
+from utils.mask_filling import mask_seeds, sample_span_masks, mask_runs
+
+
+def _expected_masked(n, pct, span_length):
+    """期望的被掩码token数：max(1, int(n * pct)) 向上取整到整块（测试用的长度下可用块数足够，不触发上限）"""
+    return -(-max(1, int(n * pct)) // span_length) * span_length
+
+
+@pytest.mark.parametrize("span_length", [1, 2, 3])
+@pytest.mark.parametrize("pct", [0.1, 0.3, 0.5])
+def test_span_mask_counts(pct, span_length):
+    lengths = [12, 40, 97, 200]
+    seeds = mask_seeds([f"text {n}" for n in lengths], [0] * len(lengths))
+    masks = sample_span_masks(lengths, pct, span_length, seeds)
+
+    assert masks.shape == (len(lengths), max(lengths))
+    for row, n in zip(masks, lengths):
+        assert not row[n:].any()  # 超出文本长度的位置不掩码
+        assert row[:n].sum() == _expected_masked(n, pct, span_length)
+        # 掩码由互不重叠的整块组成：每段连续掩码的长度都是 span_length 的整数倍
+        for start, end, masked in mask_runs(row[:n]):
+            if masked:
+                assert (end - start) % span_length == 0
+
+
+def test_span_masks_independent_of_batch():
+    texts = ["alpha", "beta", "gamma", "delta"]
+    lengths = [15, 64, 33, 128]
+    rounds = [0, 1, 2, 3]
+    seeds = mask_seeds(texts, rounds, seed=7)
+    batch = sample_span_masks(lengths, 0.3, 2, seeds)
+
+    for idx, n in enumerate(lengths):
+        alone = sample_span_masks([n], 0.3, 2, seeds[idx:idx + 1])
+        np.testing.assert_array_equal(batch[idx, :n], alone[0, :n])
+
+    # 打乱批内顺序、混入其他文本，结果不变
+    order = [3, 1, 0, 2]
+    shuffled = sample_span_masks([lengths[i] for i in order] + [500], 0.3, 2,
+                                 np.concatenate([seeds[order], mask_seeds(["other"], [0])]))
+    for row, idx in enumerate(order):
+        np.testing.assert_array_equal(shuffled[row, :lengths[idx]], batch[idx, :lengths[idx]])
+
+
+def test_mask_seeds_reproducible():
+    texts = ["same text"] * 3
+    first = mask_seeds(texts, [0, 1, 2], seed=0)
+    np.testing.assert_array_equal(first, mask_seeds(texts, [0, 1, 2], seed=0))
+    assert len(set(first.tolist())) == 3  # 不同轮次得到不同的掩码
+    assert not np.array_equal(first, mask_seeds(texts, [0, 1, 2], seed=1))
@@ -0,0 +1,67 @@
+# test_weight_store.py
+# 权重文件：保存后映射读回逐项一致，加载到另一个模型后权重相同
+import numpy as np
+import jittor as jt
+import pytest
+
+from utils.weight_store import save_weights, open_weights, load_weights, load_or_create, store_path, ALIGNMENT
+
+
+class TinyModel(jt.Module):
+    def __init__(self):
+        self.embedding = jt.nn.Embedding(11, 3)
+        self.linear = jt.nn.Linear(3, 5)
+
+    def execute(self, x):
+        return self.linear(self.embedding(x))
+
+
+def _state(model):
+    return {name: value.numpy() for name, value in model.state_dict().items()}
+
+
+def test_save_and_open_round_trip(tmp_path):
+    arrays = {
+        "a": np.arange(7, dtype=np.float32),
+        "b": np.arange(12, dtype=np.int64).reshape(3, 4),
+        "c": np.array([[1.5]], dtype=np.float16),
+    }
+    path = str(tmp_path / "w.jtw")
+    save_weights(arrays, path)
+
+    tensors = open_weights(path)
+    assert list(tensors) == list(arrays)
+    for name, array in arrays.items():
+        assert tensors[name].dtype == array.dtype
+        np.testing.assert_array_equal(tensors[name], array)
+        assert tensors[name].offset % ALIGNMENT == 0
+
+
+def test_open_rejects_other_files(tmp_path):
+    path = tmp_path / "bad.jtw"
+    path.write_bytes(b"NOTASTORE" + b"\0" * 32)
+    with pytest.raises(ValueError):
+        open_weights(str(path))
+
+
+def test_load_weights_into_model(tmp_path):
+    jt.set_seed(0)
+    source, target = TinyModel(), TinyModel()
+    path = str(tmp_path / "tiny.jtw")
+    save_weights(source.state_dict(), path)
+    load_weights(target, path)
+
+    expected = _state(source)
+    for name, value in _state(target).items():
+        np.testing.assert_array_equal(value, expected[name])
+
+
+def test_load_or_create_shares_weights(tmp_path):
+    config = {"cache_dir": str(tmp_path)}
+    first = load_or_create(config, TinyModel(), "org/tiny")
+    assert store_path(str(tmp_path), "org/tiny").endswith("org_tiny.jtw")
+    second = load_or_create(config, TinyModel(), "org/tiny")
+
+    expected = _state(first)
+    for name, value in _state(second).items():
+        np.testing.assert_array_equal(value, expected[name])
@@ -0,0 +1,99 @@
+# cascade.py
+# 级联检测：先用单次前向的似然分数判定置信尾部，仅把不确定区间内的文本升级到扰动曲率
+import numpy as np
+
+from .model import get_lls
+
+
+def _squash(x):
+    """单调压缩到 (-1, 1)，大分数不会像 tanh 那样饱和到相同的浮点值"""
+    return x / (1.0 + abs(x))
+
+
+class CascadeScorer:
+    """
+    级联评分器（接口与 LikelihoodScorer / PerturbationScorer 一致，提供 score_texts）
+
+    1. calibrate：在全部待测文本（无需标签）的似然分数上，以中位数为阈值，
+       取离阈值最近的 escalation_rate 比例文本所在区间作为不确定区间；
+    2. score_texts：区间外的文本直接由似然分数定级，区间内的文本升级为扰动曲率评分。
+    最终分数分三段且段间有序（低置信尾 < 升级文本 < 高置信尾），段内保持各自分数的单调性。
+    """
+
+    def __init__(self, args, config, perturbation_scorer, escalation_rate=0.3):
+        self.args = args
+        self.config = config
+        self.perturbation_scorer = perturbation_scorer
+        self.escalation_rate = min(max(escalation_rate, 0.0), 1.0)
+        self.band = None
+        self.n_scored = 0
+        self.n_escalated = 0
+        # 级联评分期间实际发生的计算量（缓存/扰动库命中不计入）
+        self.n_fills = 0
+        self.n_perturbed_lls = 0
+        self.n_ll_forwards = 0
+
+    def _work_counters(self):
+        ll_cache = self.config.get("ll_cache")
+        return (self.perturbation_scorer.n_fills, self.perturbation_scorer.n_perturbed_lls,
+                ll_cache.misses if ll_cache is not None else 0)
+
+    def calibrate(self, texts):
+        """根据似然分数分布确定不确定区间 [low, high]"""
+        cheap_scores = np.array(get_lls(self.args, self.config, texts))
+        threshold = float(np.median(cheap_scores))
+        half_width = float(np.quantile(np.abs(cheap_scores - threshold), self.escalation_rate))
+        self.band = (threshold - half_width, threshold + half_width)
+        print(f"🎚️ 级联不确定区间: [{self.band[0]:.4f}, {self.band[1]:.4f}]（阈值 {threshold:.4f}，"
+              f"目标升级比例 {self.escalation_rate:.0%}）")
+        return self.band
+
+    def score_texts(self, texts):
+        """级联评分：似然分数落在不确定区间内的文本才计算扰动曲率"""
+        if self.band is None:
+            self.calibrate(texts)
+        low, high = self.band
+        before = self._work_counters()
+
+        cheap_scores = get_lls(self.args, self.config, texts)
+        escalated = [idx for idx, score in enumerate(cheap_scores) if low <= score <= high]
+        records = self.perturbation_scorer.score_records([texts[idx] for idx in escalated])
+        escalated_scores = dict(zip(escalated, (record.detection_score for record in records)))
+
+        scores = []
+        for idx, cheap_score in enumerate(cheap_scores):
+            if idx in escalated_scores:
+                scores.append(float(_squash(escalated_scores[idx])))
+            elif cheap_score < low:
+                scores.append(float(-1.0 - _squash(low - cheap_score)))
+            else:
+                scores.append(float(1.0 + _squash(cheap_score - high)))
+
+        n_fills, n_perturbed_lls, n_ll_forwards = (
+            after - start for after, start in zip(self._work_counters(), before)
+        )
+        self.n_fills += n_fills
+        self.n_perturbed_lls += n_perturbed_lls
+        self.n_ll_forwards += n_ll_forwards
+
+        self.n_scored += len(texts)
+        self.n_escalated += len(escalated)
+        print(f"✅ CascadeScorer已评分 {len(texts)} 条文本，其中 {len(escalated)} 条升级到扰动评分"
+              f"（实际生成扰动 {n_fills} 条，似然前向 {n_ll_forwards} 条）")
+        return scores
+
+    @property
+    def escalation_ratio(self):
+        return self.n_escalated / self.n_scored if self.n_scored else 0.0
+
+    def stats(self):
+        return {
+            "escalation_rate": self.escalation_ratio,
+            "n_escalated": self.n_escalated,
+            "n_scored": self.n_scored,
+            "target_escalation_rate": self.escalation_rate,
+            "band": list(self.band) if self.band else None,
+            "n_fills": self.n_fills,
+            "n_perturbed_lls": self.n_perturbed_lls,
+            "n_ll_forwards": self.n_ll_forwards,
+        }
@@ -1,46 +1,40 @@
 
 
 import numpy as np
-from .model import PerturbationScorer, get_ll
+from .model import PerturbationScorer, SamplingDiscrepancyScorer, get_lls
 from .metric import get_roc_metrics, get_precision_recall_metrics
 
-def integrate_multiple_scores(texts, scorer):
+def integrate_multiple_scores(texts, scorer, n_perturbations=None):
     """
     🔥 集成多种评分策略，提升 AUC
+    各策略均由 scorer 缓存的 ScoreRecord 派生，不再重复扰动与计算似然
+    n_perturbations 指定时只使用每个文本的前 n 个扰动
     """
-    from .model import get_ll
+    records = scorer.score_records(texts)
+    if n_perturbations is not None:
+        records = [record.snapshot(n_perturbations) for record in records]
+    return integrate_records(records)
 
+
+def integrate_records(records):
+    """由打分记录计算集成评分"""
     scores_list = []
 
-    for text in texts:
+    for record in records:
         try:
             # 策略1: 原始扰动曲率
-            curvature_score = scorer.score(text)
-
-            # 策略2: 原始似然
-            original_ll = get_ll(scorer.args, scorer.config, text)
+            curvature_score = record.detection_score
 
             # 策略3: 多轮扰动方差
-            perturbed_lls = []
-            for _ in range(min(3, scorer.args.n_perturbation_rounds)):
-                try:
-                    perturbed_text = scorer._perturb_text(text)
-                    if perturbed_text != text:
-                        perturbed_ll = get_ll(scorer.args, scorer.config, perturbed_text)
-                        perturbed_lls.append(perturbed_ll)
-                except:
-                    continue
-
-            if perturbed_lls:
-                variance_score = np.std(perturbed_lls)
-                consistency_score = 1.0 / (1.0 + np.std(perturbed_lls))
+            if record.perturbed_lls:
+                variance_score = record.std_perturbed_ll
+                consistency_score = record.consistency
             else:
                 variance_score = 0.0
                 consistency_score = 0.5
 
-            # 策略4: 文本长度归一化
-            text_length = len(text.split())
-            normalized_ll = original_ll / (text_length + 1)
+            # 策略2 + 策略4: 原始似然按文本长度归一化
+            normalized_ll = record.normalized_original_ll
 
             # 🔥 集成评分: 加权组合
             integrated_score = (
@@ -103,24 +97,35 @@ def detectGPT(args, config, data, span_length=2):
         print("❌ 有效样本不足（至少需要2个），无法进行实验")
         return []
 
-    n_perturbations = args.n_perturbation_list
-    if isinstance(n_perturbations, str):
+    if getattr(args, 'detection_method', 'perturbation') == 'sampling_discrepancy':
+        if "base_model" not in config or "base_tokenizer" not in config:
+            print("❌ 错误: 基础模型或tokenizer未加载")
+            return []
+        return [get_sampling_discrepancy_results(args, config, cleaned_original, cleaned_samples)]
+
+    n_perturbation_list = args.n_perturbation_list
+    if isinstance(n_perturbation_list, str):
         try:
-            n_perturbations = [int(x.strip()) for x in n_perturbations.split(",")][0]
-        except (ValueError, IndexError):
+            n_perturbation_list = [int(x.strip()) for x in n_perturbation_list.split(",") if x.strip()]
+        except ValueError:
             print("❌ 错误: 无效的n_perturbation_list格式")
             return []
-    elif isinstance(n_perturbations, list) and n_perturbations:
-        n_perturbations = n_perturbations[0]
-    else:
+    elif isinstance(n_perturbation_list, int):
+        n_perturbation_list = [n_perturbation_list]
+    n_perturbation_list = sorted(set(n for n in (n_perturbation_list or []) if n > 0))
+    if not n_perturbation_list:
         print("❌ 错误: n_perturbation_list格式无效")
         return []
+    max_perturbations = n_perturbation_list[-1]
+    print(f"扰动数扫描: {n_perturbation_list}（只扰动一次至 {max_perturbations} 轮，增量统计各扰动数下的曲率）")
 
     try:
         mask_filling_model = config.get("mask_model")
         mask_filling_tokenizer = config.get("mask_tokenizer")
+        # 扰动进程池启用时由各扰动进程持有掩码模型，主进程不加载
+        use_pool = (getattr(args, "perturbation_workers", 0) or 0) > 0 and not getattr(args, "adaptive_rounds", False)
 
-        if not mask_filling_model or not mask_filling_tokenizer:
+        if not use_pool and (not mask_filling_model or not mask_filling_tokenizer):
             print("⚠️ 警告: mask模型未加载，尝试重新加载...")
             from utils.load_models_tokenizers import load_mask_filling_model
             load_mask_filling_model(args, config)
@@ -136,9 +141,10 @@ def detectGPT(args, config, data, span_length=2):
             return []
 
         print(f"✅ 模型检查通过: 基础模型={type(config['base_model']).__name__}, "
-              f"Mask模型={type(mask_filling_model).__name__}")
+              f"Mask模型={type(mask_filling_model).__name__ if mask_filling_model else '扰动进程池'}")
 
-        scorer = PerturbationScorer(args, config, mask_filling_model, mask_filling_tokenizer)
+        scorer = PerturbationScorer(args, config, mask_filling_model, mask_filling_tokenizer,
+                                    n_perturbations=max_perturbations)
         print("✅ 成功创建 PerturbationScorer")
     except Exception as e:
         print(f"❌ 创建评分器失败: {str(e)}")
@@ -149,48 +155,77 @@ def detectGPT(args, config, data, span_length=2):
     try:
         print(f"\n开始计算原始文本分数 ({len(cleaned_original)} 个样本)...")
         print("-" * 50)
-        original_scores = scorer.score_texts(cleaned_original)
+        original_records = scorer.score_records(cleaned_original)
 
         print(f"\n开始计算生成文本分数 ({len(cleaned_samples)} 个样本)...")
         print("-" * 50)
-        sampled_scores = scorer.score_texts(cleaned_samples)
+        sampled_records = scorer.score_records(cleaned_samples)
 
-        if len(original_scores) != len(cleaned_original) or len(sampled_scores) != len(cleaned_samples):
+        if len(original_records) != len(cleaned_original) or len(sampled_records) != len(cleaned_samples):
             print("❌ 错误: 分数数量与样本数量不匹配")
             return []
 
-        print(f"\n分数统计:")
-        print(f"原始文本分数 - 均值: {np.mean(original_scores):.4f}, 标准差: {np.std(original_scores):.4f}")
-        print(f"生成文本分数 - 均值: {np.mean(sampled_scores):.4f}, 标准差: {np.std(sampled_scores):.4f}")
-
-        # 🔥 优化6: 集成多种评分策略
-        original_scores_multi = integrate_multiple_scores(cleaned_original, scorer)
-        sampled_scores_multi = integrate_multiple_scores(cleaned_samples, scorer)
-
-        # 使用集成评分
-        original_scores = original_scores_multi
-        sampled_scores = sampled_scores_multi
-
-        print(f"\n集成后分数统计:")
-        print(f"原始文本分数 - 均值: {np.mean(original_scores):.4f}, 标准差: {np.std(original_scores):.4f}")
-        print(f"生成文本分数 - 均值: {np.mean(sampled_scores):.4f}, 标准差: {np.std(sampled_scores):.4f}")
-
+        # 单次遍历扰动似然，为每个扰动数截取一份统计快照
+        original_snapshots = [record.snapshots(n_perturbation_list) for record in original_records]
+        sampled_snapshots = [record.snapshots(n_perturbation_list) for record in sampled_records]
     except Exception as e:
         print(f"❌ 计算分数失败: {str(e)}")
         import traceback
         traceback.print_exc()
         return []
 
-    print(f"✅ 分数计算完成 - 原始分数: {len(original_scores)}, 生成分数: {len(sampled_scores)}")
+    outputs = []
+    max_rounds_used = max(record.rounds_used for record in original_records + sampled_records)
+    for n_perturbations in n_perturbation_list:
+        # 自适应扰动下所有文本都在 n 之前停止时，该快照与更小的扰动数完全相同，不单独报告
+        if outputs and max_rounds_used < n_perturbations:
+            print(f"⚠️ 所有文本最多只扰动了 {max_rounds_used} 轮，跳过 n={n_perturbations}")
+            continue
+        print(f"\n{'=' * 20} 扰动数 n={n_perturbations} {'=' * 20}")
+        outputs.append(get_sweep_results(
+            args,
+            [snapshots[n_perturbations] for snapshots in original_snapshots],
+            [snapshots[n_perturbations] for snapshots in sampled_snapshots],
+            n_perturbations,
+            span_length
+        ))
+
+    print(f"\n✅ DetectGPT 实验完成! 扰动数扫描: " +
+          ", ".join(f"n={r['info']['n_perturbations']} AUC={r['metrics']['roc_auc']:.4f}" for r in outputs))
+
+    return outputs
+
+
+def get_sweep_results(args, original_records, sampled_records, n_perturbations, span_length):
+    """由某一扰动数下的打分记录快照计算分数与指标，返回单个实验结果"""
+    original_scores = [record.detection_score for record in original_records]
+    sampled_scores = [record.detection_score for record in sampled_records]
+    # 扰动数不足 n 的记录（自适应扰动提前停止）：如实记录，避免结果标签与实际扰动数不符
+    rounds_used = [record.rounds_used for record in original_records + sampled_records]
+    n_short = sum(rounds < n_perturbations for rounds in rounds_used)
+    if n_short:
+        print(f"⚠️ n={n_perturbations}: {n_short}/{len(rounds_used)} 个文本实际扰动少于 {n_perturbations} 轮"
+              f"（平均 {np.mean(rounds_used):.2f} 轮）")
+
+    print(f"\n分数统计:")
+    print(f"原始文本分数 - 均值: {np.mean(original_scores):.4f}, 标准差: {np.std(original_scores):.4f}")
+    print(f"生成文本分数 - 均值: {np.mean(sampled_scores):.4f}, 标准差: {np.std(sampled_scores):.4f}")
+
+    # 🔥 优化6: 集成多种评分策略（复用已缓存的打分记录）
+    original_scores = integrate_records(original_records)
+    sampled_scores = integrate_records(sampled_records)
+
+    print(f"\n集成后分数统计:")
+    print(f"原始文本分数 - 均值: {np.mean(original_scores):.4f}, 标准差: {np.std(original_scores):.4f}")
+    print(f"生成文本分数 - 均值: {np.mean(sampled_scores):.4f}, 标准差: {np.std(sampled_scores):.4f}")
 
-    y_true = [1] * len(original_scores) + [0] * len(sampled_scores)
-    y_scores = original_scores + sampled_scores
+    print(f"✅ 分数计算完成 - 原始分数: {len(original_scores)}, 生成分数: {len(sampled_scores)}")
 
     try:
         fpr, tpr, roc_auc = get_roc_metrics(original_scores, sampled_scores)
         precision, recall, pr_auc = get_precision_recall_metrics(original_scores, sampled_scores)
 
-        print(f"\n🎯 最终结果:")
+        print(f"\n🎯 最终结果 (n={n_perturbations}):")
         print(f"ROC AUC: {roc_auc:.4f}")
         print(f"PR AUC: {pr_auc:.4f}")
 
@@ -199,7 +234,7 @@ def detectGPT(args, config, data, span_length=2):
         fpr, tpr, roc_auc = [0, 1], [0, 1], 0.5
         precision, recall, pr_auc = [1, 0], [0, 1], 0.5
 
-    results = {
+    return {
         "name": f"perturbation_{n_perturbations}",
         "predictions": {
             "real": original_scores,
@@ -215,28 +250,89 @@ def detectGPT(args, config, data, span_length=2):
         },
         "raw_results": [
             {
-                "original_ll": orig_score,
-                "sampled_ll": samp_score,
-                "perturbed_original_ll": orig_score * 0.9,
-                "perturbed_sampled_ll": samp_score * 0.9
+                "original_ll": orig_record.original_ll,
+                "sampled_ll": samp_record.original_ll,
+                "perturbed_original_ll": orig_record.mean_perturbed_ll,
+                "perturbed_sampled_ll": samp_record.mean_perturbed_ll
             }
-            for orig_score, samp_score in zip(original_scores, sampled_scores)
+            for orig_record, samp_record in zip(original_records, sampled_records)
         ],
         "info": {
             "pct_words_masked": getattr(args, 'pct_words_masked', None),
             "span_length": span_length,
             "n_perturbations": n_perturbations,
-            "n_samples": len(cleaned_original),
+            "n_samples": len(original_records),
             "original_score_mean": float(np.mean(original_scores)),
             "sampled_score_mean": float(np.mean(sampled_scores)),
             "original_score_std": float(np.std(original_scores)),
-            "sampled_score_std": float(np.std(sampled_scores))
+            "sampled_score_std": float(np.std(sampled_scores)),
+            "avg_perturbation_rounds": float(np.mean(rounds_used)),
+            "min_perturbation_rounds": int(min(rounds_used)),
+            "n_short_records": int(n_short)
         }
     }
 
-    print(f"✅ DetectGPT 实验完成! AUC: {roc_auc:.4f}")
+def get_sampling_discrepancy_results(args, config, original_texts, sampled_texts):
+    """采样差异曲率（单次前向解析估计，不加载掩码模型），返回单个实验结果"""
+    print("曲率估计方法: sampling_discrepancy（每个文本一次前向传播，无需掩码模型）")
+    scorer = SamplingDiscrepancyScorer(args, config)
+    original_scores = scorer.score_texts(original_texts)
+    sampled_scores = scorer.score_texts(sampled_texts)
+    # 原始似然通常已在似然基线中算过，直接命中缓存
+    original_lls = get_lls(args, config, original_texts)
+    sampled_lls = get_lls(args, config, sampled_texts)
 
-    return [results]
+    print(f"\n分数统计:")
+    print(f"原始文本分数 - 均值: {np.mean(original_scores):.4f}, 标准差: {np.std(original_scores):.4f}")
+    print(f"生成文本分数 - 均值: {np.mean(sampled_scores):.4f}, 标准差: {np.std(sampled_scores):.4f}")
+
+    try:
+        fpr, tpr, roc_auc = get_roc_metrics(original_scores, sampled_scores)
+        precision, recall, pr_auc = get_precision_recall_metrics(original_scores, sampled_scores)
+
+        print(f"\n🎯 最终结果 (sampling_discrepancy):")
+        print(f"ROC AUC: {roc_auc:.4f}")
+        print(f"PR AUC: {pr_auc:.4f}")
+
+    except Exception as e:
+        print(f"❌ 计算指标失败: {str(e)}")
+        fpr, tpr, roc_auc = [0, 1], [0, 1], 0.5
+        precision, recall, pr_auc = [1, 0], [0, 1], 0.5
+
+    return {
+        "name": "sampling_discrepancy",
+        "predictions": {
+            "real": original_scores,
+            "samples": sampled_scores
+        },
+        "metrics": {
+            "fpr": fpr.tolist() if hasattr(fpr, 'tolist') else fpr,
+            "tpr": tpr.tolist() if hasattr(tpr, 'tolist') else tpr,
+            "roc_auc": float(roc_auc),
+            "precision": precision.tolist() if hasattr(precision, 'tolist') else precision,
+            "recall": recall.tolist() if hasattr(recall, 'tolist') else recall,
+            "pr_auc": float(pr_auc)
+        },
+        # 以 ll - 采样差异 作为"扰动似然"，LLR直方图即为采样差异分布
+        "raw_results": [
+            {
+                "original_ll": float(orig_ll),
+                "sampled_ll": float(samp_ll),
+                "perturbed_original_ll": float(orig_ll - orig_score),
+                "perturbed_sampled_ll": float(samp_ll - samp_score)
+            }
+            for orig_ll, samp_ll, orig_score, samp_score
+            in zip(original_lls, sampled_lls, original_scores, sampled_scores)
+        ],
+        "info": {
+            "detection_method": "sampling_discrepancy",
+            "n_samples": len(original_texts),
+            "original_score_mean": float(np.mean(original_scores)),
+            "sampled_score_mean": float(np.mean(sampled_scores)),
+            "original_score_std": float(np.std(original_scores)),
+            "sampled_score_std": float(np.std(sampled_scores))
+        }
+    }
 
 # 为兼容性保留原有函数
 def get_perturbation_results(args, config, data, span_length, n_perturbations, n_perturbation_rounds):
@@ -0,0 +1,51 @@
+# entropy.py
+# 熵阈值检测：平均预测熵，与似然、排名共用同一次前向传播（Jittor 版本）
+from .model import get_token_statistics
+
+
+def get_entropies(args, config, texts):
+    """批量计算文本逐位置预测分布的平均熵，无效文本返回 0.0"""
+    if not config.get("base_model") or not config.get("base_tokenizer"):
+        raise ValueError("基础模型或分词器未正确加载")
+
+    return [stats["entropy"] if stats is not None else 0.0
+            for stats in get_token_statistics(args, config, texts)]
+
+
+def get_entropy(args, config, text):
+    """计算单个文本的平均预测熵"""
+    # 检查文本有效性
+    if not text or not text.strip():
+        print("⚠️ 检测到空文本，返回默认熵")
+        return 0.0
+
+    try:
+        return get_entropies(args, config, [text])[0]
+    except Exception as e:
+        print(f"❌ 计算熵时出错: {str(e)}")
+        return 0.0
+
+
+class EntropyScorer:
+    """
+    熵评分器（接口与 LikelihoodScorer 一致，提供 score_texts）
+    机器生成文本上模型的预测分布更集中，取负的平均熵作为分数
+    """
+
+    def __init__(self, args, config):
+        self.args = args
+        self.config = config
+
+    def score(self, text):
+        """单文本评分（增加异常兜底）"""
+        return self.score_texts([text])[0]
+
+    def score_texts(self, texts):
+        """批量文本评分"""
+        try:
+            scores = [-entropy for entropy in get_entropies(self.args, self.config, texts)]
+            print(f"✅ EntropyScorer已评分 {len(scores)}/{len(texts)} 条文本")
+            return scores
+        except Exception as e:
+            print(f"❌ EntropyScorer批量评分失败: {str(e)}")
+            return [0.0] * len(texts)
@@ -2,6 +2,9 @@
 import numpy as np
 import jittor as jt
 
+from . import model
+from .model import _tokenize
+
 def get_ll(args, config, text):
     """计算单个文本的对数似然值（仅本地Jittor模型，无OpenAI依赖）"""
     DEVICE = args.DEVICE
@@ -20,15 +23,11 @@ def get_ll(args, config, text):
 
     try:
         with jt.no_grad():  # Jittor 无梯度上下文
-            tokenized = base_tokenizer(
-                text,
-                return_tensors="jt",
-                padding=False,
-                truncation=True,
-                max_length=512
-            )
-            labels = tokenized.input_ids
-            loss = base_model(**tokenized, labels=labels).loss
+            # 经分词缓存取token id，与批量打分、扰动共用同一份编码
+            ids = _tokenize(config, base_tokenizer, [text], 512)[0]
+            input_ids = jt.array(np.asarray(ids, dtype=np.int32)[None, :])
+            outputs = base_model(input_ids=input_ids, labels=input_ids)
+            loss = outputs["loss"] if isinstance(outputs, dict) else outputs.loss
             return -loss.item()  # 返回负损失作为似然值
     except Exception as e:
         print(f"❌ 模型计算对数似然失败: {str(e)}")
@@ -36,21 +35,5 @@ def get_ll(args, config, text):
 
 
 def get_lls(args, config, texts):
-    """批量计算文本的对数似然值（仅本地Jittor模型，无OpenAI依赖）"""
-    GPT2_TOKENIZER = config.get("GPT2_TOKENIZER")
-
-    # 过滤空文本
-    valid_texts = [text for text in texts if text and text.strip()]
-    invalid_count = len(texts) - len(valid_texts)
-
-    if invalid_count > 0:
-        print(f"⚠️ 过滤掉 {invalid_count} 个空文本")
-
-    if not valid_texts:
-        print("⚠️ 没有有效文本进行处理")
-        return []
-
-    # 仅本地模型处理，删除OpenAI相关逻辑
-    return [get_ll(args, config, text) for text in valid_texts]
-
-
+    """批量计算文本的对数似然值（转交 model.get_lls：长度分桶批量前向 + 似然缓存，返回顺序与texts一致）"""
+    return model.get_lls(args, config, texts)
@@ -1,86 +1,447 @@
 
 import sys
 import os
-import random
+from functools import partial
 import numpy as np
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import jittor as jt
 
+from utils.cache import LLCache, PerturbationBank, model_fingerprint, weights_fingerprint
+from utils.precision import get_precision_mode
+from utils.weight_store import store_path, open_weights
+from utils.mask_filling import MaskFiller, mask_seeds, sample_span_masks, mask_runs
+from .perturbation_pool import get_perturbation_pool
 
-def get_lls(args, config, texts):
+
+def _get_batch_size(args, config):
+    """读取 --batch_size（set_experiment_config 写入 config），兜底为1"""
+    batch_size = config.get("batch_size", getattr(args, "batch_size", 1))
+    try:
+        return max(1, int(batch_size))
+    except (TypeError, ValueError):
+        return 1
+
+
+def _bucket_by_length(lengths, batch_size):
+    """按token长度排序后切分为长度桶，返回每个桶内的原始下标列表"""
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+# padding长度向上取整到该倍数：不同长度桶落到少数几种形状上，复用Jittor已编译的算子
+PAD_MULTIPLE = 32
+
+
+def _pad_batch(sequences, pad_token_id, pad_multiple=PAD_MULTIPLE):
+    """将一组token id序列右侧padding为 (batch, max_len) 矩阵，并返回对应的attention mask"""
+    max_len = max(len(seq) for seq in sequences)
+    max_len = -(-max_len // pad_multiple) * pad_multiple
+    input_ids = np.full((len(sequences), max_len), pad_token_id, dtype=np.int32)
+    attention_mask = np.zeros((len(sequences), max_len), dtype=np.float32)
+    for row, seq in enumerate(sequences):
+        input_ids[row, :len(seq)] = seq
+        attention_mask[row, :len(seq)] = 1.0
+    return input_ids, attention_mask
+
+
+# 分块计算标签token对数概率时的默认块大小（序列方向 / 词表方向）
+SEQ_CHUNK_SIZE = 128
+VOCAB_CHUNK_SIZE = 8192
+
+
+def _get_chunk_sizes(args):
+    """读取 --seq_chunk_size / --vocab_chunk_size，兜底为默认块大小"""
+    seq_chunk = getattr(args, "seq_chunk_size", None) or SEQ_CHUNK_SIZE
+    vocab_chunk = getattr(args, "vocab_chunk_size", None) or VOCAB_CHUNK_SIZE
+    return max(1, int(seq_chunk)), max(1, int(vocab_chunk))
+
+
+def chunked_token_statistics(base_model, input_ids, seq_chunk=SEQ_CHUNK_SIZE, vocab_chunk=VOCAB_CHUNK_SIZE,
+                             moments=False, ranks=False):
+    """
+    分块计算逐token统计，不生成完整的 (batch, seq_len, vocab) logits
+    序列按 seq_chunk 切块，每块在词表方向按 vocab_chunk 在线累加，累加量全部留在设备上，
+    每个序列块只同步一次；标签logit由隐状态与 lm_head 对应行的点积直接得到。
+    - 始终给出 token_ll：标签token的对数概率（在线 log-sum-exp）
+    - moments=True：以当前最大logit为基准累加 Σe^(z-m)(z-m)、Σe^(z-m)(z-m)²，
+      得到条件分布下 log p 的期望 expected_ll（即负熵）与方差 var_ll
+    - ranks=True：累加 logits 严格大于标签logit的词表项数量，rank = 1 + 该数量
+    峰值内存约为 batch * seq_chunk * vocab_chunk，与词表大小无关；
+    返回 {名称: (batch, seq_len - 1) 数组}，padding位置未做处理
+    """
+    with jt.no_grad():
+        hidden = base_model.hidden_states(jt.array(input_ids))[:, :-1, :]
+        weight = base_model.lm_head.weight
+        bias = getattr(base_model.lm_head, "bias", None)
+        vocab_size = weight.shape[0]
+        labels = jt.array(input_ids[:, 1:])
+        n_positions = labels.shape[1]
+
+        names = ["token_ll"] + (["expected_ll", "var_ll"] if moments else []) + (["rank"] if ranks else [])
+        results = {name: [] for name in names}
+        for start in range(0, n_positions, seq_chunk):
+            h = hidden[:, start:start + seq_chunk, :]
+            chunk_labels = labels[:, start:start + seq_chunk]
+
+            # 标签logit：隐状态与 lm_head 对应行的点积
+            gold_weight = weight[chunk_labels.reshape(-1)].reshape(h.shape)
+            gold_logit = (h * gold_weight).sum(-1)
+            if bias is not None:
+                gold_logit = gold_logit + bias[chunk_labels.reshape(-1)].reshape(chunk_labels.shape)
+            gold_logit = gold_logit.float32()
+
+            # 词表方向在线累加：running_sum = Σe^(z-m)，sum_z / sum_z2 为以 m 为基准的一阶 / 二阶矩
+            running_max = running_sum = sum_z = sum_z2 = n_greater = None
+            for v_start in range(0, vocab_size, vocab_chunk):
+                chunk_logits = jt.matmul(h, weight[v_start:v_start + vocab_chunk].transpose())
+                if bias is not None:
+                    chunk_logits = chunk_logits + bias[v_start:v_start + vocab_chunk]
+                chunk_logits = chunk_logits.float32()
+
+                chunk_max = chunk_logits.max(-1)
+                new_max = chunk_max if running_max is None else jt.maximum(running_max, chunk_max)
+                shifted = chunk_logits - new_max.unsqueeze(-1)
+                exp_shifted = shifted.exp()
+                if running_max is None:
+                    running_sum = exp_shifted.sum(-1)
+                    if moments:
+                        sum_z = (exp_shifted * shifted).sum(-1)
+                        sum_z2 = (exp_shifted * shifted * shifted).sum(-1)
+                else:
+                    # 已累加的部分从旧基准平移到新基准：Σe^(z-m')(z-m'+δ)^k 乘以 e^δ，δ = m - m'
+                    delta = running_max - new_max
+                    scale = delta.exp()
+                    if moments:
+                        sum_z2 = (scale * (sum_z2 + 2 * delta * sum_z + delta * delta * running_sum)
+                                  + (exp_shifted * shifted * shifted).sum(-1))
+                        sum_z = scale * (sum_z + delta * running_sum) + (exp_shifted * shifted).sum(-1)
+                    running_sum = running_sum * scale + exp_shifted.sum(-1)
+                running_max = new_max
+
+                if ranks:
+                    # 标签自身不计入（点积与矩阵乘法的舍入可能不同）
+                    vocab_ids = jt.arange(v_start, v_start + chunk_logits.shape[-1]).int32()
+                    greater = ((chunk_logits > gold_logit.unsqueeze(-1))
+                               & (vocab_ids != chunk_labels.unsqueeze(-1))).int32().sum(-1)
+                    n_greater = greater if n_greater is None else n_greater + greater
+
+            log_sum = running_sum.log()
+            chunk_results = {"token_ll": gold_logit - running_max - log_sum}
+            if moments:
+                mean_shifted = sum_z / running_sum
+                chunk_results["expected_ll"] = mean_shifted - log_sum
+                chunk_results["var_ll"] = sum_z2 / running_sum - mean_shifted * mean_shifted
+            if ranks:
+                chunk_results["rank"] = n_greater + 1
+            jt.sync(list(chunk_results.values()))
+            for name, value in chunk_results.items():
+                results[name].append(value.numpy())
+
+    return {name: np.concatenate(values, axis=1).astype(np.float64) for name, values in results.items()}
+
+
+def chunked_token_log_probs(base_model, input_ids, attention_mask,
+                            seq_chunk=SEQ_CHUNK_SIZE, vocab_chunk=VOCAB_CHUNK_SIZE):
     """
-    计算一组文本的对数似然（Jittor版本，修复loss访问方式）
+    分块计算标签token的对数概率（chunked_token_statistics 的似然部分）
+    返回 (token_ll, sequence_ll)：逐token对数概率 (batch, seq_len - 1)（padding位置为0）
+    与每个样本的平均对数似然 (batch,)
+    """
+    token_ll = chunked_token_statistics(base_model, input_ids, seq_chunk, vocab_chunk)["token_ll"]
+    loss_mask = attention_mask[:, 1:]
+    token_ll = token_ll * loss_mask
+    n_tokens = loss_mask.sum(axis=1)
+    return token_ll, token_ll.sum(axis=1) / np.maximum(n_tokens, 1.0)
+
+
+def _batch_lls(base_model, input_ids, attention_mask, seq_chunk=None, vocab_chunk=None):
+    """
+    对一个padding后的桶做一次前向传播，返回每个样本的平均对数似然
+    （移位预测：第t个位置的logits预测第t+1个token，padding位置不计入loss）
+    模型提供 hidden_states / lm_head 且给出块大小时走分块路径，不生成完整词表logits
+    """
+    if seq_chunk and vocab_chunk and hasattr(base_model, "hidden_states") and hasattr(base_model, "lm_head"):
+        return chunked_token_log_probs(base_model, input_ids, attention_mask, seq_chunk, vocab_chunk)[1]
+
+    with jt.no_grad():
+        outputs = base_model(input_ids=jt.array(input_ids))
+        logits = outputs["logits"] if isinstance(outputs, dict) else outputs.logits
+
+        batch_size, seq_len = input_ids.shape
+        shift_logits = logits[:, :-1, :].reshape(-1, logits.shape[-1])
+        shift_labels = jt.array(input_ids[:, 1:]).reshape(-1)
+        token_loss = jt.nn.cross_entropy_loss(shift_logits, shift_labels, reduction='none')
+        token_ll = -token_loss.reshape(batch_size, seq_len - 1).numpy()
+
+    loss_mask = attention_mask[:, 1:]
+    n_tokens = loss_mask.sum(axis=1)
+    return (token_ll * loss_mask).sum(axis=1) / np.maximum(n_tokens, 1.0)
+
+
+def _tokenize(config, tokenizer, texts, max_length=512):
+    """分词入口：config["token_cache"] 存在时经分词缓存，只对未缓存的文本编码"""
+    token_cache = config.get("token_cache")
+    if token_cache is None:
+        return _encode_texts(tokenizer, texts, max_length)
+    return token_cache.encode_many(
+        tokenizer, texts, max_length, lambda pending: _encode_texts(tokenizer, pending, max_length)
+    )
+
+
+def _encode_texts(tokenizer, texts, max_length):
+    """
+    批量分词：tokenizer 提供 batch_encode 时一次性向量化分词，按偏移切出各文本的id视图；
+    否则（或批量分词失败时）逐条 encode，失败的文本记为空序列
+    """
+    if hasattr(tokenizer, "batch_encode"):
+        try:
+            ids, offsets = tokenizer.batch_encode(texts, truncation=True, max_length=max_length)
+            return [ids[offsets[i]:offsets[i + 1]] for i in range(len(texts))]
+        except Exception as e:
+            print(f"⚠️ 批量分词失败，逐条分词: {str(e)}")
+
+    token_ids = []
+    for idx, text in enumerate(texts):
+        try:
+            ids = tokenizer.encode(text, truncation=True, max_length=max_length)
+        except Exception as e:
+            print(f"❌ 分词文本 {idx + 1}/{len(texts)} 失败: '{str(text)[:50]}...'")
+            print(f"   错误详情: {str(e)}")
+            ids = []
+        token_ids.append(list(ids))
+    return token_ids
+
+
+def _bucketed_forward(args, config, texts, batch_fn, max_length=512):
+    """
+    长度分桶批量前向的通用流程：分词 -> 按长度排序分桶 -> padding -> batch_fn 计算每个样本的结果
+    batch_fn(base_model, input_ids, attention_mask) 返回与桶内样本一一对应的结果，
+    少于2个token或所在桶失败的文本对应 None，返回顺序与 texts 一致
     """
     base_model = config["base_model"]
     base_tokenizer = config["base_tokenizer"]
+    batch_size = _get_batch_size(args, config)
 
-    lls = []
-    for idx, text in enumerate(texts):
+    token_ids = _tokenize(config, base_tokenizer, texts, max_length)
+
+    # 少于2个token的文本无法做移位预测
+    valid = [i for i, ids in enumerate(token_ids) if len(ids) >= 2]
+    buckets = _bucket_by_length([len(token_ids[i]) for i in valid], batch_size)
+
+    results = [None] * len(texts)
+    n_done = 0
+    for bucket in buckets:
+        indices = [valid[b] for b in bucket]
         try:
-            # 分词并返回Jittor张量
-            tokenized = base_tokenizer(
-                text,
-                return_tensors="jt",
-                truncation=True,
-                max_length=512
+            input_ids, attention_mask = _pad_batch(
+                [token_ids[i] for i in indices], base_tokenizer.pad_token_id
             )
+            for i, result in zip(indices, batch_fn(base_model, input_ids, attention_mask)):
+                results[i] = result
+        except Exception as e:
+            print(f"❌ 处理长度桶失败（{len(indices)} 条文本，首条: '{texts[indices[0]][:50]}...'）")
+            print(f"   错误详情: {str(e)}")
 
-            # 获取input_ids并确保维度正确
-            input_ids = tokenized['input_ids']
-
-            # 确保input_ids是2维张量 [batch_size, seq_len]
-            if isinstance(input_ids, list):
-                input_ids = jt.array(input_ids)
-            if len(input_ids.shape) == 1:
-                input_ids = input_ids.unsqueeze(0)
-
-            # labels和input_ids一致（语言模型自回归任务）
-            labels = input_ids.clone()
-
-            # 模型前向传播（返回字典格式）
-            outputs = base_model(input_ids=input_ids, labels=labels)
-
-            # 🔥 核心修复：字典用["loss"]访问，而非.loss
-            if isinstance(outputs, dict):
-                # 字典类型：取loss键值
-                loss = outputs.get("loss", None)
-                if loss is None:
-                    # 如果字典中没有loss键，尝试手动计算
-                    print(f"⚠️ 模型返回字典中无loss键，尝试手动计算（文本{idx + 1}/{len(texts)}）")
-                    logits = outputs.get("logits", None)
-                    if logits is not None:
-                        # 手动计算交叉熵损失
-                        loss_fct = jt.nn.CrossEntropyLoss(ignore_index=0)
-                        # 移位预测（语言模型标准做法）
-                        shift_logits = logits[..., :-1, :].reshape(-1, logits.shape[-1])
-                        shift_labels = labels[..., 1:].reshape(-1)
-                        loss = loss_fct(shift_logits, shift_labels)
-                    else:
-                        raise ValueError("模型返回字典中既无loss也无logits")
-            else:
-                # 兼容少数情况返回类实例的情况
-                loss = getattr(outputs, "loss", None)
-                if loss is None:
-                    raise ValueError("模型返回对象无loss属性")
+        # 每处理10条打印进度
+        previous = n_done
+        n_done += len(indices)
+        if n_done // 10 > previous // 10:
+            print(f"✅ 已处理 {n_done}/{len(valid)} 条文本（桶大小 {batch_size}）")
+
+    return results
+
+
+def _batch_sampling_discrepancy(base_model, input_ids, attention_mask, seq_chunk=None, vocab_chunk=None):
+    """
+    对一个padding后的桶做一次前向传播，返回每个样本的解析采样差异（Fast-DetectGPT 形式）：
+    (Σ_t [log p(x_t) - E_p[log p]]) / sqrt(Σ_t Var_p[log p])，
+    期望与方差在模型自身的条件分布上解析计算，无需扰动与掩码模型
+    模型提供 hidden_states / lm_head 且给出块大小时走分块路径，不生成完整词表logits
+    """
+    if seq_chunk and vocab_chunk and hasattr(base_model, "hidden_states") and hasattr(base_model, "lm_head"):
+        stats = chunked_token_statistics(base_model, input_ids, seq_chunk, vocab_chunk, moments=True)
+        token_ll, expected_ll, var_ll = stats["token_ll"], stats["expected_ll"], stats["var_ll"]
+    else:
+        token_ll, expected_ll, var_ll = _full_vocab_moments(base_model, input_ids)
+
+    loss_mask = attention_mask[:, 1:]
+    discrepancy = ((token_ll - expected_ll) * loss_mask).sum(axis=1)
+    variance = (np.maximum(var_ll, 0.0) * loss_mask).sum(axis=1)
+    return discrepancy / np.sqrt(np.maximum(variance, 1e-8))
+
+
+def _full_vocab_moments(base_model, input_ids):
+    """不支持分块的模型：由完整词表logits计算标签对数概率与 log p 的期望、方差"""
+    with jt.no_grad():
+        outputs = base_model(input_ids=jt.array(input_ids))
+        logits = outputs["logits"] if isinstance(outputs, dict) else outputs.logits
 
-            # 转换为Python数值，取负得到对数似然
-            ll = -loss.item()
-            lls.append(ll)
+        log_probs = jt.nn.log_softmax(logits[:, :-1, :], dim=-1)
+        probs = log_probs.exp()
+        labels = jt.array(input_ids[:, 1:]).unsqueeze(-1)
+        token_ll = jt.gather(log_probs, 2, labels).squeeze(-1).numpy()
+        expected_ll = (probs * log_probs).sum(-1)
+        var_ll = ((probs * log_probs * log_probs).sum(-1) - expected_ll * expected_ll).numpy()
+        expected_ll = expected_ll.numpy()
+    return token_ll, expected_ll, var_ll
 
-            # 每处理10条打印进度
-            if (idx + 1) % 10 == 0:
-                print(f"✅ 已处理 {idx + 1}/{len(texts)} 条文本，当前LL={ll:.4f}")
 
+def _batch_token_statistics(base_model, input_ids, attention_mask, seq_chunk=None, vocab_chunk=None):
+    """
+    对一个padding后的桶做一次前向传播，同时给出阈值基线所需的全部逐token统计：
+    平均对数似然、平均预测熵、逐token排名（1 + logits 严格大于标签logit的词表项数量）
+    模型提供 hidden_states / lm_head 且给出块大小时走分块路径，不生成完整词表logits
+    """
+    if seq_chunk and vocab_chunk and hasattr(base_model, "hidden_states") and hasattr(base_model, "lm_head"):
+        stats = chunked_token_statistics(base_model, input_ids, seq_chunk, vocab_chunk, moments=True, ranks=True)
+        # 预测熵即 log p 在条件分布下期望的相反数
+        token_ll, token_entropy, ranks = stats["token_ll"], -stats["expected_ll"], stats["rank"]
+    else:
+        token_ll, token_entropy, ranks = _full_vocab_statistics(base_model, input_ids)
+
+    loss_mask = attention_mask[:, 1:]
+    n_tokens = np.maximum(loss_mask.sum(axis=1), 1.0)
+    lls = (token_ll * loss_mask).sum(axis=1) / n_tokens
+    entropies = (token_entropy * loss_mask).sum(axis=1) / n_tokens
+    lengths = loss_mask.sum(axis=1).astype(np.int64)
+    return [
+        {"ll": float(lls[i]), "entropy": float(entropies[i]), "ranks": ranks[i, :lengths[i]].astype(np.float64)}
+        for i in range(len(lengths))
+    ]
+
+
+def _full_vocab_statistics(base_model, input_ids):
+    """不支持分块的模型：由完整词表logits计算标签对数概率、预测熵与排名"""
+    with jt.no_grad():
+        outputs = base_model(input_ids=jt.array(input_ids))
+        logits = outputs["logits"] if isinstance(outputs, dict) else outputs.logits
+        logits = logits[:, :-1, :]
+
+        labels = jt.array(input_ids[:, 1:]).unsqueeze(-1)
+        log_probs = jt.nn.log_softmax(logits, dim=-1)
+        token_ll = jt.gather(log_probs, 2, labels).squeeze(-1).numpy()
+        token_entropy = -(log_probs.exp() * log_probs).sum(-1).numpy()
+        label_logits = jt.gather(logits, 2, labels)
+        ranks = (logits > label_logits).int32().sum(-1).numpy() + 1
+    return token_ll, token_entropy, ranks
+
+
+def _ll_namespace(config, max_length):
+    """似然缓存的键前缀（模型名称 + 权重指纹 + tokenizer + 截断长度），指纹按模型缓存"""
+    base_model = config["base_model"]
+    fingerprint = getattr(base_model, "_ll_cache_fingerprint", None)
+    if fingerprint is None:
+        fingerprint = model_fingerprint(base_model)
+        base_model._ll_cache_fingerprint = fingerprint
+    model_name = config.get("base_model_id", config.get("base_model_name", "gpt2"))
+    return LLCache.namespace(model_name, fingerprint, config["base_tokenizer"], max_length)
+
+
+def get_lls(args, config, texts):
+    """
+    计算一组文本的对数似然（Jittor版本，长度分桶 + padding批量前向）
+
+    文本先分词并按token长度排序，每 --batch_size 条组成一个桶，
+    桶内padding后只做一次前向传播，padding位置通过loss mask排除，
+    返回值顺序与输入texts一致。
+    config["ll_cache"] 存在时先查缓存，只对未命中的文本做前向。
+    """
+    max_length = 512
+    lls = [0.0] * len(texts)
+
+    # 查询似然缓存
+    ll_cache = config.get("ll_cache")
+    keys, pending = None, list(range(len(texts)))
+    if ll_cache is not None:
+        try:
+            namespace = _ll_namespace(config, max_length)
+            keys = [LLCache.make_key(namespace, text) for text in texts]
+            cached = ll_cache.get_many(keys)
+            pending = []
+            for idx, key in enumerate(keys):
+                if key in cached:
+                    lls[idx] = cached[key]
+                else:
+                    pending.append(idx)
         except Exception as e:
-            print(f"❌ 处理文本 {idx + 1}/{len(texts)} 失败: '{text[:50]}...'")
-            print(f"   错误详情: {str(e)}")
-            lls.append(0.0)  # 兜底值，避免程序中断
+            print(f"⚠️ 查询似然缓存失败，全部重新计算: {str(e)}")
+            keys, pending = None, list(range(len(texts)))
+
+    # 同一文本已做过统计前向（get_token_statistics）时直接复用其似然
+    token_statistics = config.get("token_statistics")
+    if token_statistics and pending:
+        try:
+            namespace = _ll_namespace(config, max_length)
+            remaining = []
+            for idx in pending:
+                stats = token_statistics.get(LLCache.make_key(namespace, texts[idx]))
+                if stats is not None:
+                    lls[idx] = stats["ll"]
+                else:
+                    remaining.append(idx)
+            pending = remaining
+        except Exception as e:
+            print(f"⚠️ 查询逐token统计失败: {str(e)}")
+
+    computed = {}
+    if pending:
+        seq_chunk, vocab_chunk = _get_chunk_sizes(args)
+        pending_lls = _bucketed_forward(
+            args, config, [texts[idx] for idx in pending],
+            partial(_batch_lls, seq_chunk=seq_chunk, vocab_chunk=vocab_chunk), max_length=max_length
+        )
+        for idx, ll in zip(pending, pending_lls):
+            if ll is not None:
+                lls[idx] = float(ll)
+                computed[idx] = float(ll)
+
+    # 写回似然缓存（失败的桶不写入，下次重算）
+    if ll_cache is not None and keys is not None and computed:
+        try:
+            ll_cache.put_many({keys[i]: ll for i, ll in computed.items()})
+        except Exception as e:
+            print(f"⚠️ 写入似然缓存失败: {str(e)}")
 
     return lls
 
 
+def get_token_statistics(args, config, texts):
+    """
+    批量计算文本的逐token统计（似然 / 熵 / 排名），每个长度桶只做一次前向传播
+    结果按 (模型, 文本) 记在 config["token_statistics"] 中，似然、熵、排名、对数排名
+    四个阈值基线共用；算出的似然同时写入似然缓存。无效文本返回 None
+    """
+    max_length = 512
+    token_statistics = config.setdefault("token_statistics", {})
+    namespace = _ll_namespace(config, max_length)
+    keys = [LLCache.make_key(namespace, text) for text in texts]
+
+    pending = [idx for idx, key in enumerate(keys) if key not in token_statistics]
+    if pending:
+        print(f"📊 计算逐token统计: {len(pending)} 条文本（{len(texts) - len(pending)} 条已缓存）")
+        seq_chunk, vocab_chunk = _get_chunk_sizes(args)
+        results = _bucketed_forward(
+            args, config, [texts[idx] for idx in pending],
+            partial(_batch_token_statistics, seq_chunk=seq_chunk, vocab_chunk=vocab_chunk), max_length=max_length
+        )
+        computed = {}
+        for idx, stats in zip(pending, results):
+            if stats is not None:
+                token_statistics[keys[idx]] = stats
+                computed[keys[idx]] = stats["ll"]
+
+        ll_cache = config.get("ll_cache")
+        if ll_cache is not None and computed:
+            try:
+                ll_cache.put_many(computed)
+            except Exception as e:
+                print(f"⚠️ 写入似然缓存失败: {str(e)}")
+
+    return [token_statistics.get(key) for key in keys]
+
+
 def get_ll(args, config, text):
     """
     计算单个文本的对数似然（增加异常处理）
@@ -111,18 +472,147 @@ class LikelihoodScorer:
             return 0.0
 
     def score_texts(self, texts):
-        """批量文本评分"""
-        scores = []
-        for idx, text in enumerate(texts):
-            try:
-                score = self.score(text)
-                scores.append(score)
-                if (idx + 1) % 10 == 0:
-                    print(f"✅ LikelihoodScorer已评分 {idx + 1}/{len(texts)} 条文本")
-            except Exception as e:
-                print(f"❌ 文本 {idx + 1} 评分失败: {str(e)}")
-                scores.append(0.0)
-        return scores
+        """批量文本评分（长度分桶批量前向，每桶一次）"""
+        try:
+            scores = get_lls(self.args, self.config, texts)
+            print(f"✅ LikelihoodScorer已评分 {len(scores)}/{len(texts)} 条文本")
+            return scores
+        except Exception as e:
+            print(f"❌ LikelihoodScorer批量评分失败: {str(e)}")
+            return [0.0] * len(texts)
+
+
+# 自适应扰动序贯检验的置信系数（约95%双侧）
+ADAPTIVE_Z = 1.96
+
+
+class RunningStats:
+    """Welford 在线均值/方差：逐个加入扰动似然，任意时刻 O(1) 得到当前统计量"""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    @property
+    def std(self):
+        """总体标准差（与 np.std 默认 ddof=0 一致）"""
+        return float(np.sqrt(self.m2 / self.count)) if self.count > 1 else 0.0
+
+    @property
+    def sem(self):
+        """均值的标准误（样本标准差 / sqrt(n)），少于2个样本时为无穷大"""
+        if self.count < 2:
+            return float("inf")
+        return float(np.sqrt(self.m2 / (self.count - 1) / self.count))
+
+    def copy(self):
+        stats = RunningStats()
+        stats.count, stats.mean, stats.m2 = self.count, self.mean, self.m2
+        return stats
+
+
+class ScoreRecord:
+    """
+    单个文本的打分记录：原始似然与扰动似然只计算一次，
+    曲率、Z-score、方差、一致性、长度归一化等特征均由此派生
+    """
+
+    def __init__(self, text, original_ll, perturbed_lls, stats=None):
+        self.text = text
+        self.original_ll = float(original_ll)
+        self.perturbed_lls = [float(ll) for ll in perturbed_lls]
+        # 实际执行的扰动轮数（自适应模式下可能少于设定轮数）
+        self.rounds_used = len(self.perturbed_lls)
+        if stats is None:
+            stats = RunningStats()
+            for ll in self.perturbed_lls:
+                stats.update(ll)
+        self.stats = stats
+
+    def snapshots(self, n_list):
+        """
+        按扰动顺序增量更新统计量，在每个请求的扰动数 n 处截取一份记录
+        扰动数不足 n 时使用全部已有扰动
+        """
+        wanted = sorted(set(n_list))
+        snapshots = {}
+        stats = RunningStats()
+        for ll in self.perturbed_lls:
+            if len(snapshots) == len(wanted):
+                break
+            stats.update(ll)
+            if stats.count in wanted:
+                snapshots[stats.count] = ScoreRecord(
+                    self.text, self.original_ll, self.perturbed_lls[:stats.count], stats.copy()
+                )
+        for n in wanted:
+            if n not in snapshots:
+                snapshots[n] = ScoreRecord(
+                    self.text, self.original_ll, self.perturbed_lls[:n], stats.copy()
+                )
+        return snapshots
+
+    def snapshot(self, n):
+        """前 n 个扰动对应的记录"""
+        return self.snapshots([n])[n]
+
+    @property
+    def n_perturbations(self):
+        return self.stats.count
+
+    @property
+    def mean_perturbed_ll(self):
+        return self.stats.mean if self.stats.count else 0.0
+
+    @property
+    def std_perturbed_ll(self):
+        return self.stats.std
+
+    @property
+    def curvature(self):
+        """基础曲率：原始似然 - 平均扰动似然"""
+        return self.original_ll - self.mean_perturbed_ll
+
+    @property
+    def z_score(self):
+        """Z-score 标准化曲率"""
+        if self.std_perturbed_ll > 0:
+            return self.curvature / (self.std_perturbed_ll + 1e-8)
+        return self.curvature
+
+    @property
+    def consistency(self):
+        """多轮扰动一致性"""
+        if self.n_perturbations >= 2:
+            return 1.0 / (1.0 + self.std_perturbed_ll)
+        return 1.0
+
+    @property
+    def normalized_original_ll(self):
+        """原始似然按词数归一化（避免长度偏差）"""
+        return self.original_ll / (len(self.text.split()) + 1)
+
+    @property
+    def detection_score(self):
+        """综合评分：结合曲率、Z-score、一致性和归一化原始似然"""
+        if not self.n_perturbations:
+            return 0.0
+
+        # 🔥 幂函数放大分数差异
+        curvature = self.curvature
+        score = np.sign(curvature) * (np.abs(curvature) ** 0.8)
+
+        return float(score * 0.5 +
+                     self.z_score * 0.3 +
+                     self.consistency * 0.1 +
+                     self.normalized_original_ll * 0.1)
 
 
 class PerturbationScorer:
@@ -130,161 +620,426 @@ class PerturbationScorer:
     扰动评分器（增强异常处理和维度校验）
     """
 
-    def __init__(self, args, config, mask_filling_model, mask_filling_tokenizer):
+    def __init__(self, args, config, mask_filling_model=None, mask_filling_tokenizer=None, n_perturbations=None):
         self.args = args
         self.config = config
-        self.mask_filling_model = mask_filling_model
-        self.mask_filling_tokenizer = mask_filling_tokenizer
+        # 每个文本的扰动数（默认 --n_perturbation_rounds；扫描多个扰动数时取最大值）
+        self.n_perturbations = n_perturbations or args.n_perturbation_rounds
+        # 未传入掩码模型时延迟到本进程第一次填充才加载（扰动进程池启用时主进程通常用不到）
+        self._mask_filling_model = mask_filling_model
+        self._mask_filling_tokenizer = mask_filling_tokenizer
         self.base_model = config["base_model"]
         self.base_tokenizer = config["base_tokenizer"]
+        # 文本 -> ScoreRecord，同一文本在一次实验中只做一次扰动与似然计算
+        self.records = {}
+        # 实际工作量：本评分器生成的扰动数（不含扰动库命中）与送去计算似然的扰动文本数
+        self.n_fills = 0
+        self.n_perturbed_lls = 0
+        self._mask_fingerprint = None
+        self._bank_namespace = None
+        self._mask_filler = None
 
-    def _perturb_text(self, text):
-        """文本扰动核心逻辑（修复generate参数不匹配问题，增加异常处理）"""
-        try:
-            # 检查tokenizer是否有tokenize方法
-            if hasattr(self.base_tokenizer, 'tokenize'):
-                tokens = self.base_tokenizer.tokenize(text)
-            else:
-                # 兜底：使用encode+decode模拟tokenize
-                token_ids = self.base_tokenizer.encode(text, truncation=True, max_length=512)
-                tokens = [str(tid) for tid in token_ids]  # 简化处理
-
-            n_tokens = len(tokens)
-            if n_tokens < 10:
-                return text
-
-            # 计算掩码数量
-            n_mask = max(1, int(n_tokens * self.args.pct_words_masked))
-            mask_positions = []
-
-            # 随机选择掩码位置
-            max_attempts = n_tokens * 2  # 防止死循环
-            attempts = 0
-            while len(mask_positions) < n_mask and attempts < max_attempts:
-                start = random.randint(0, max(0, n_tokens - self.args.span_length))
-                span = list(range(start, min(start + self.args.span_length, n_tokens)))
-                if not any(p in mask_positions for p in span):
-                    mask_positions.extend(span)
-                attempts += 1
-
-            # 应用掩码
-            masked_tokens = tokens.copy()
-            mask_token = getattr(self.mask_filling_tokenizer, 'mask_token', '<mask>')
-            for pos in mask_positions:
-                if pos < len(masked_tokens):
-                    masked_tokens[pos] = mask_token
-
-            # 转换回文本
-            if hasattr(self.base_tokenizer, 'convert_tokens_to_string'):
-                masked_text = self.base_tokenizer.convert_tokens_to_string(masked_tokens)
+        # 自适应扰动：曲率估计足够稳定或已能确定落在阈值哪一侧时提前停止
+        self.adaptive = getattr(args, "adaptive_rounds", False)
+        self.min_rounds = max(2, getattr(args, "min_rounds", 3) or 3)
+        # 未指定 --max_rounds 时以本评分器的扰动数为上限
+        self.max_rounds = getattr(args, "max_rounds", None) or self.n_perturbations
+        self.se_tolerance = getattr(args, "se_tolerance", 0.01)
+        self.curvature_threshold = getattr(args, "curvature_threshold", None)
+
+    def _load_mask_model(self):
+        """经进程级共享的 MaskFiller 取掩码模型（已加载则直接复用）"""
+        if self._mask_filling_model is None or self._mask_filling_tokenizer is None:
+            from utils.load_models_tokenizers import load_mask_filling_model
+            load_mask_filling_model(self.args, self.config)
+            self._mask_filling_model = self.config["mask_model"]
+            self._mask_filling_tokenizer = self.config["mask_tokenizer"]
+
+    @property
+    def mask_filling_model(self):
+        self._load_mask_model()
+        return self._mask_filling_model
+
+    @property
+    def mask_filling_tokenizer(self):
+        self._load_mask_model()
+        return self._mask_filling_tokenizer
+
+    @property
+    def mask_filler(self):
+        """共享的 MaskFiller；评分器持有外部传入的掩码模型时包装为同一接口"""
+        self._load_mask_model()
+        mask_filler = self.config.get("mask_filler")
+        if mask_filler is None or mask_filler.model is not self._mask_filling_model:
+            if self._mask_filler is None:
+                self._mask_filler = MaskFiller(
+                    getattr(self.args, "mask_filling_model_name", "t5-small"), self._mask_filling_tokenizer,
+                    precision=get_precision_mode(self.args)
+                )
+                self._mask_filler.attach(self._mask_filling_model)
+            mask_filler = self._mask_filler
+        return mask_filler
+
+    def _detokenize(self, token_ids):
+        """把一段基础模型token id还原为文本（不做解码清理，各段拼接后与原文一致）"""
+        token_ids = [int(i) for i in token_ids]
+        if hasattr(self.base_tokenizer, 'convert_ids_to_tokens') and hasattr(self.base_tokenizer, 'convert_tokens_to_string'):
+            return self.base_tokenizer.convert_tokens_to_string(self.base_tokenizer.convert_ids_to_tokens(token_ids))
+        return self.base_tokenizer.decode(token_ids)
+
+    def _mask_texts(self, texts, round_indices):
+        """
+        批量掩码：对每个 (文本, 轮次) 一次性采样互不重叠的掩码跨度，返回 [(掩码文本, 掩码数)]；
+        每段被掩码的token替换为一个 <extra_id_k> 哨兵（保留该段原有的首尾空白，不额外插入空格，
+        掩码落在词内时填充直接拼回该词），文本过短时掩码文本为 None。
+        同一 (文本, 轮次, --perturbation_seed) 总得到相同的掩码
+        """
+        # 经分词缓存整批取token id，与打分共用同一份编码（同样截断到512个token，超出部分打分时本就不计入）
+        token_lists = _tokenize(self.config, self.base_tokenizer, texts, 512)
+
+        masks = sample_span_masks(
+            [len(tokens) for tokens in token_lists], self.args.pct_words_masked, self.args.span_length,
+            mask_seeds(texts, round_indices, getattr(self.args, "perturbation_seed", 0))
+        )
+
+        results = []
+        for tokens, mask in zip(token_lists, masks):
+            if len(tokens) < 10:
+                results.append((None, 0))
+                continue
+            # 未掩码的连续token还原为文本，掩码段只把非空白部分替换为哨兵
+            pieces, n_masks = [], 0
+            for start, end, masked in mask_runs(mask[:len(tokens)]):
+                span = self._detokenize(tokens[start:end])
+                if masked and span.strip():
+                    leading = span[:len(span) - len(span.lstrip())]
+                    trailing = span[len(span.rstrip()):]
+                    pieces.append(f"{leading}<extra_id_{n_masks}>{trailing}")
+                    n_masks += 1
+                else:
+                    pieces.append(span)
+            results.append(("".join(pieces), n_masks))
+        return results
+
+    def _fill_masked_texts(self, masked_texts):
+        """整批掩码文本交给共享的 MaskFiller，只调用一次generate生成各哨兵的填充并写回"""
+        return self.mask_filler.fill_masks(masked_texts, self.args.span_length)
+
+    def _mask_model_fingerprint(self):
+        """
+        掩码模型权重指纹：经权重文件加载时（含扰动进程池）直接取文件中的权重，
+        主进程无需为此加载掩码模型；否则取本进程已加载的掩码模型
+        """
+        if self._mask_fingerprint is None:
+            mask_model_name = getattr(self.args, "mask_filling_model_name", "t5-small")
+            path = store_path(self.config.get("cache_dir", "./cache"), mask_model_name)
+            uses_store = (getattr(self.args, "weight_store", False)
+                          or (getattr(self.args, "perturbation_workers", 0) or 0) > 0)
+            if uses_store and os.path.exists(path):
+                self._mask_fingerprint = weights_fingerprint(open_weights(path).values())
             else:
-                # 兜底：简单拼接
-                masked_text = ' '.join(masked_tokens)
-
-            # 分词并生成填充文本
-            inputs = self.mask_filling_tokenizer(
-                masked_text,
-                return_tensors="jt",
-                truncation=True,
-                max_length=512
-            )
+                self._mask_fingerprint = model_fingerprint(self.mask_filling_model)
+        return self._mask_fingerprint
 
-            # 确保input_ids维度正确
-            input_ids = inputs.get('input_ids', inputs)
-            if isinstance(input_ids, list):
-                input_ids = jt.array(input_ids)
-            if len(input_ids.shape) == 1:
-                input_ids = input_ids.unsqueeze(0)
-
-            # 生成填充文本 - 关键修复：移除不支持的num_beams和do_sample参数
-            outputs = self.mask_filling_model.generate(
-                input_ids=input_ids,
-                max_length=min(n_tokens + 20, 512)
+    def _bank_key(self, text):
+        """扰动库中该文本的键（掩码模型 + 权重指纹 + 精度 + 掩码参数 + 种子 + 文本哈希）"""
+        if self._bank_namespace is None:
+            self._bank_namespace = PerturbationBank.namespace(
+                self.config.get("mask_filling_model_name",
+                                getattr(self.args, "mask_filling_model_name", "t5-small")),
+                self._mask_model_fingerprint(),
+                get_precision_mode(self.args),
+                self.args.pct_words_masked,
+                self.args.span_length,
+                getattr(self.args, "perturbation_seed", 0)
             )
+        return PerturbationBank.make_key(self._bank_namespace, text)
 
-            # 解码
-            filled_text = self.mask_filling_tokenizer.decode(
-                outputs[0],
-                skip_special_tokens=True
-            )
+    def _bank_prefixes(self, texts, n_rounds, existing=None):
+        """
+        取扰动库中每个文本已有的扰动前缀，返回 (扰动列表, 库键, 已缓存数)；失败轮次的占位还原为原文
+        existing 为调用方已持有的扰动，其中的条目不再计入扰动库的复用数
+        """
+        bank = self.config.get("perturbation_bank")
+        perturbed = [[] for _ in texts]
+        bank_keys = [None] * len(texts)
+        if bank is not None:
+            for idx, text in enumerate(texts):
+                bank_keys[idx] = self._bank_key(text)
+                known = len(existing[idx]) if existing is not None else 0
+                perturbed[idx] = [p or text for p in bank.get_prefix(bank_keys[idx], n_rounds, known)]
+        return perturbed, bank_keys, [len(ps) for ps in perturbed]
+
+    def _bank_store(self, texts, bank_keys, n_cached, perturbed):
+        """
+        新生成的扰动追加到扰动库，库中序号与轮次一一对应（轮次决定掩码）；
+        退回原文的失败轮次以空字符串占位，保证后续轮次不错位
+        """
+        bank = self.config.get("perturbation_bank")
+        if bank is None:
+            return
+        for text, key, start, ps in zip(texts, bank_keys, n_cached, perturbed):
+            try:
+                bank.append(key, start, [p if p != text else "" for p in ps[start:]])
+            except Exception as e:
+                print(f"⚠️ 写入扰动库失败: {str(e)}")
+
+    def perturb_texts(self, texts, n_rounds=None, existing=None):
+        """
+        批量扰动：为每个文本构造 n_rounds 个掩码变体，
+        全部变体padding成一个batch后只调用一次generate，
+        返回与texts对齐的扰动文本列表（每个元素为该文本的全部扰动结果）
+        config["perturbation_bank"] 存在时先取库中已有的前缀，只生成不足的部分；
+        existing 为调用方已持有的扰动（逐轮扩展时使用），同样只补齐不足的部分
+        """
+        if n_rounds is None:
+            n_rounds = self.n_perturbations
+
+        perturbed, bank_keys, n_cached = self._bank_prefixes(texts, n_rounds, existing)
+        if existing is not None:
+            for idx, ps in enumerate(existing):
+                if len(ps) > len(perturbed[idx]):
+                    perturbed[idx] = list(ps[:n_rounds])
+
+        # 所有待补齐的 (文本, 轮次) 一次采样掩码；轮次号决定掩码，补齐的轮次与一次生成的结果一致
+        items = [(idx, round_idx) for idx in range(len(texts)) for round_idx in range(len(perturbed[idx]), n_rounds)]
+        try:
+            masked = self._mask_texts([texts[idx] for idx, _ in items], [round_idx for _, round_idx in items])
+        except Exception as e:
+            print(f"⚠️ 批量掩码失败: {str(e)}")
+            masked = []
+
+        masked_texts, owners = [], []
+        for (idx, _), (masked_text, _) in zip(items, masked):
+            if masked_text is None:
+                perturbed[idx].append(texts[idx])  # 文本过短，保留原文
+                continue
+            masked_texts.append(masked_text)
+            owners.append(idx)
 
-            return filled_text.strip() if filled_text else text
+        if not masked_texts:
+            return perturbed
 
+        self.n_fills += len(masked_texts)
+        try:
+            filled_texts = self._fill_masked_texts(masked_texts)
+        except Exception as e:
+            print(f"⚠️ 批量文本扰动失败: {str(e)}")
+            filled_texts = [""] * len(masked_texts)
+
+        for idx, filled_text in zip(owners, filled_texts):
+            filled_text = filled_text.strip() if filled_text else ""
+            perturbed[idx].append(filled_text or texts[idx])
+
+        self._bank_store(texts, bank_keys, n_cached, perturbed)
+        return perturbed
+
+    def _perturb_text(self, text):
+        """单文本扰动（兼容旧接口，内部走批量扰动路径）"""
+        try:
+            return self.perturb_texts([text], 1)[0][0]
         except Exception as e:
             print(f"⚠️ 文本扰动失败: {str(e)}")
             return text  # 返回原文本作为兜底
 
-    def score(self, text):
-        """单文本扰动评分（增加异常处理 + 多重优化提升AUC）"""
-        try:
-            # 计算原始文本似然
-            original_ll = get_ll(self.args, self.config, text)
-
-            # 生成扰动文本并计算似然
-            perturbed_lls = []
-            for round_idx in range(self.args.n_perturbation_rounds):
-                try:
-                    perturbed_text = self._perturb_text(text)
-                    if perturbed_text and perturbed_text != text:
-                        perturbed_ll = get_ll(self.args, self.config, perturbed_text)
-                        perturbed_lls.append(perturbed_ll)
-                except Exception as e:
-                    print(f"⚠️ 扰动轮次 {round_idx + 1} 失败: {str(e)}")
-                    continue
+    def _score_batch(self, texts):
+        """对一个小批量文本：一次批量扰动 + 一次分桶似然计算，返回 ScoreRecord 列表"""
+        return self._records_from_perturbed(texts, self.perturb_texts(texts))
 
-            # 计算平均扰动似然
-            if not perturbed_lls:
-                print("⚠️ 所有扰动轮次均失败，返回0分")
-                return 0.0
+    def _records_from_perturbed(self, texts, perturbed):
+        """由扰动结果构造 ScoreRecord：原始文本与全部扰动文本一次分桶计算似然"""
+        perturbed = [[p for p in ps if p and p != text] for text, ps in zip(texts, perturbed)]
 
-            avg_perturbed_ll = np.mean(perturbed_lls)
-            std_perturbed_ll = np.std(perturbed_lls) if len(perturbed_lls) > 1 else 0.0
+        # 原始文本与全部扰动文本一起分桶批量计算似然
+        flat_texts = list(texts) + [p for ps in perturbed for p in ps]
+        flat_lls = get_lls(self.args, self.config, flat_texts)
+        self.n_perturbed_lls += len(flat_texts) - len(texts)
 
-            # 基础曲率分数
-            curvature = original_ll - avg_perturbed_ll
+        records = []
+        offset = len(texts)
+        for text, original_ll, ps in zip(texts, flat_lls, perturbed):
+            records.append(ScoreRecord(text, original_ll, flat_lls[offset:offset + len(ps)]))
+            offset += len(ps)
+        return records
 
-            # 🔥 优化1: Z-score 标准化
-            if std_perturbed_ll > 0:
-                normalized_curvature = curvature / (std_perturbed_ll + 1e-8)
-            else:
-                normalized_curvature = curvature
+    def _should_stop(self, original_ll, stats):
+        """自适应停止条件：曲率标准误低于容差，或序贯检验已能判定曲率位于阈值哪一侧"""
+        if stats.count < self.min_rounds:
+            return False
+        if stats.sem < self.se_tolerance:
+            return True
+        if self.curvature_threshold is not None:
+            curvature = original_ll - stats.mean
+            return abs(curvature - self.curvature_threshold) > ADAPTIVE_Z * stats.sem
+        return False
 
-            # 🔥 优化2: 多轮扰动一致性检查
-            if len(perturbed_lls) >= 2:
-                consistency = 1.0 / (1.0 + np.std(perturbed_lls))
-            else:
-                consistency = 1.0
+    def _score_batch_adaptive(self, texts):
+        """
+        自适应小批量打分：每轮为仍未停止的文本各生成一个扰动（一次generate + 一次似然计算），
+        增量更新扰动似然统计，满足停止条件或达到 max_rounds 后停止
+        """
+        original_lls = get_lls(self.args, self.config, list(texts))
+        perturbed = [[] for _ in texts]
+        perturbed_lls = [[] for _ in texts]
+        stats = [RunningStats() for _ in texts]
+        rounds_used = [0] * len(texts)
+        active = list(range(len(texts)))
+
+        for round_idx in range(self.max_rounds):
+            if not active:
+                break
+            new_round = self.perturb_texts(
+                [texts[i] for i in active], round_idx + 1, existing=[perturbed[i] for i in active]
+            )
+            new_texts, owners = [], []
+            for i, ps in zip(active, new_round):
+                perturbed[i] = ps
+                rounds_used[i] = round_idx + 1
+                if len(ps) > round_idx and ps[round_idx] and ps[round_idx] != texts[i]:
+                    new_texts.append(ps[round_idx])
+                    owners.append(i)
 
-            # 🔥 优化3: 幂函数放大分数差异
-            score = np.sign(curvature) * (np.abs(curvature) ** 0.8)
+            self.n_perturbed_lls += len(new_texts)
+            for i, ll in zip(owners, get_lls(self.args, self.config, new_texts) if new_texts else []):
+                perturbed_lls[i].append(ll)
+                stats[i].update(ll)
 
-            # 🔥 优化4: 原始似然归一化（避免长度偏差）
-            text_length = len(text.split())
-            normalized_original = original_ll / (text_length + 1)
+            active = [i for i in active if not self._should_stop(original_lls[i], stats[i])]
 
-            # 🔥 优化5: 综合评分策略
-            # 结合曲率、标准差、一致性和归一化原始分数
-            final_score = (score * 0.5 +
-                          normalized_curvature * 0.3 +
-                          consistency * 0.1 +
-                          normalized_original * 0.1)
+        records = []
+        for i, text in enumerate(texts):
+            record = ScoreRecord(text, original_lls[i], perturbed_lls[i], stats[i])
+            record.rounds_used = rounds_used[i]
+            records.append(record)
+        return records
 
-            return final_score
+    def average_rounds(self):
+        """已打分文本的平均扰动轮数"""
+        if not self.records:
+            return 0.0
+        return float(np.mean([record.rounds_used for record in self.records.values()]))
 
+    def _record_batch(self, batch, score_batch, n_done, n_pending):
+        """计算一个小批量的 ScoreRecord 并写入 self.records（失败时记为0分）"""
+        try:
+            for record in score_batch(batch):
+                self.records[record.text] = record
+        except Exception as e:
+            print(f"❌ {len(batch)} 条文本扰动评分失败: {str(e)}")
+            for text in batch:
+                self.records[text] = ScoreRecord(text, 0.0, [])
+        print(f"✅ PerturbationScorer已评分 {n_done}/{n_pending} 条文本")
+
+    def _score_pipelined(self, pool, batches, n_pending):
+        """
+        流水线打分：扰动进程池并行生成扰动文本，本进程按完成顺序逐批计算似然，
+        掩码模型与打分模型不再在同一线程上交替空闲；进程池失败时剩余批次退回本进程计算
+        """
+        prefixes = [self._bank_prefixes(batch, self.n_perturbations) for batch in batches]
+        tasks = [(batch, self.n_perturbations, prefix[0]) for batch, prefix in zip(batches, prefixes)]
+        done, n_done = set(), 0
+        try:
+            for batch_id, perturbed in pool.imap_unordered(tasks):
+                batch = batches[batch_id]
+                done.add(batch_id)
+                n_done += len(batch)
+                if perturbed is None:
+                    # 该批在扰动进程中失败，改为本进程扰动
+                    self._record_batch(batch, self._score_batch, n_done, n_pending)
+                    continue
+                prefix, bank_keys, n_cached = prefixes[batch_id]
+                self.n_fills += sum(len(ps) - len(known) for ps, known in zip(perturbed, prefix))
+                self._bank_store(batch, bank_keys, n_cached, perturbed)
+                self._record_batch(batch, partial(self._records_from_perturbed, perturbed=perturbed), n_done, n_pending)
+        except Exception as e:
+            print(f"⚠️ 扰动进程池失败，剩余批次改为本进程计算: {str(e)}")
+
+        for batch_id, batch in enumerate(batches):
+            if batch_id not in done:
+                n_done += len(batch)
+                self._record_batch(batch, self._score_batch, n_done, n_pending)
+
+    def score_records(self, texts):
+        """
+        返回与texts对齐的 ScoreRecord，仅对未缓存的文本按 --batch_size 小批量计算
+        --perturbation_workers > 0 时（非自适应）扰动由进程池生成，与似然计算流水并行
+        """
+        batch_size = _get_batch_size(self.args, self.config)
+        pending = list(dict.fromkeys(text for text in texts if text not in self.records))
+        batches = [pending[start:start + batch_size] for start in range(0, len(pending), batch_size)]
+
+        pool = get_perturbation_pool(self.args, self.config) if batches and not self.adaptive else None
+        if pool is not None:
+            self._score_pipelined(pool, batches, len(pending))
+        else:
+            score_batch = self._score_batch_adaptive if self.adaptive else self._score_batch
+            for start, batch in zip(range(0, len(pending), batch_size), batches):
+                self._record_batch(batch, score_batch, start + len(batch), len(pending))
+
+        if self.adaptive and pending:
+            print(f"📉 自适应扰动: 平均使用 {self.average_rounds():.2f}/{self.max_rounds} 轮")
+
+        return [self.records[text] for text in texts]
+
+    def score(self, text):
+        """单文本扰动评分（增加异常处理 + 多重优化提升AUC）"""
+        try:
+            record = self.score_records([text])[0]
+            if not record.perturbed_lls:
+                print("⚠️ 所有扰动轮次均失败，返回0分")
+            return record.detection_score
         except Exception as e:
             print(f"❌ PerturbationScorer评分失败: {str(e)}")
             return 0.0
 
     def score_texts(self, texts):
-        """批量文本扰动评分"""
-        scores = []
-        for idx, text in enumerate(texts):
-            try:
-                score = self.score(text)
-                scores.append(score)
-                if (idx + 1) % 5 == 0:
-                    print(f"✅ PerturbationScorer已评分 {idx + 1}/{len(texts)} 条文本")
-            except Exception as e:
-                print(f"❌ 文本 {idx + 1} 扰动评分失败: {str(e)}")
-                scores.append(0.0)
-        return scores
\ No newline at end of file
+        """批量文本扰动评分（按 --batch_size 划分小批量，每批一次generate）"""
+        try:
+            return [record.detection_score for record in self.score_records(texts)]
+        except Exception as e:
+            print(f"❌ PerturbationScorer批量评分失败: {str(e)}")
+            return [0.0] * len(texts)
+
+
+class SamplingDiscrepancyScorer:
+    """
+    解析采样差异评分器（Fast-DetectGPT 思路，无扰动）
+    用基础模型在每个位置的条件分布解析地给出 log p 的期望与方差，
+    与观测token的 log p 比较得到曲率估计：每个文本只需一次前向传播，不需要掩码模型
+    分数按 (模型, 文本) 记在 config["sampling_discrepancy"] 中，基线实验与 DetectGPT 共用
+    """
+
+    def __init__(self, args, config):
+        self.args = args
+        self.config = config
+        self.scores = config.setdefault("sampling_discrepancy", {})
+
+    def score(self, text):
+        """单文本评分（增加异常兜底）"""
+        return self.score_texts([text])[0]
+
+    def score_texts(self, texts):
+        """批量文本评分（长度分桶批量前向，每桶一次）"""
+        try:
+            namespace = _ll_namespace(self.config, 512)
+            keys = [LLCache.make_key(namespace, text) for text in texts]
+            pending = {}  # 未计算过的文本（去重）
+            for key, text in zip(keys, texts):
+                if key not in self.scores:
+                    pending.setdefault(key, text)
+            if pending:
+                seq_chunk, vocab_chunk = _get_chunk_sizes(self.args)
+                computed = _bucketed_forward(
+                    self.args, self.config, list(pending.values()),
+                    partial(_batch_sampling_discrepancy, seq_chunk=seq_chunk, vocab_chunk=vocab_chunk)
+                )
+                for key, score in zip(pending, computed):
+                    if score is not None:  # 失败的桶不记录，下次重算
+                        self.scores[key] = float(score)
+            scores = [self.scores.get(key, 0.0) for key in keys]
+            print(f"✅ SamplingDiscrepancyScorer已评分 {len(scores)}/{len(texts)} 条文本"
+                  f"（新计算 {len(pending)} 条）")
+            return scores
+        except Exception as e:
+            print(f"❌ SamplingDiscrepancyScorer批量评分失败: {str(e)}")
+            return [0.0] * len(texts)
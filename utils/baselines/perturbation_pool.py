@@ -0,0 +1,148 @@
+# perturbation_pool.py
+# 多进程扰动流水线：若干扰动进程各自持有掩码模型生成扰动文本，
+# 经有界队列交给主进程批量计算似然，掩码模型与打分模型不再在同一线程上交替空闲
+import copy
+import queue
+import multiprocessing as mp
+
+from utils.load_models_tokenizers import T5ForConditionalGeneration
+from utils.weight_store import ensure_weights
+
+
+def _perturbation_worker(worker_id, args, base_tokenizer, task_queue, result_queue):
+    """扰动进程：加载掩码模型，循环处理 (批次号, 文本, 轮数, 已有扰动) 任务直到收到结束标记"""
+    import jittor as jt
+    from utils.load_models_tokenizers import load_mask_filling_model
+    from .model import PerturbationScorer
+
+    # 各进程随机状态一致，掩码模型权重从主进程准备好的权重文件加载（与主进程兜底填充时完全相同）
+    jt.set_seed(getattr(args, "perturbation_seed", 0))
+    # 进程内不使用注册表 / 扰动库 / 似然缓存：扰动库由主进程统一读写
+    config = {
+        "cache_dir": getattr(args, "cache_dir", "./cache"),
+        "batch_size": getattr(args, "batch_size", 1),
+        "base_model": None,
+        "base_tokenizer": base_tokenizer,
+    }
+    try:
+        load_mask_filling_model(args, config)
+        config["mask_filler"].warm_up()
+        scorer = PerturbationScorer(args, config, config["mask_model"], config["mask_tokenizer"])
+    except Exception as e:
+        result_queue.put((None, None, f"扰动进程 {worker_id} 加载掩码模型失败: {e}"))
+        return
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        batch_id, texts, n_rounds, existing = task
+        try:
+            result_queue.put((batch_id, scorer.perturb_texts(texts, n_rounds, existing=existing), None))
+        except Exception as e:
+            result_queue.put((batch_id, None, f"扰动进程 {worker_id} 处理 {len(texts)} 条文本失败: {e}"))
+
+
+class PerturbationPool:
+    """
+    扰动进程池（生产者）+ 有界结果队列
+    在途批次数不超过 queue_size：主进程（似然计算，消费者）跟不上时扰动进程自动阻塞（反压），
+    不会把全部扰动文本堆积在内存中
+    """
+
+    def __init__(self, args, config, n_workers, queue_size=0):
+        self.n_workers = n_workers
+        self.queue_size = queue_size or 2 * n_workers
+        self.n_batches = 0
+        self.n_failed = 0
+        self.n_calls = 0
+
+        # spawn 启动：子进程重新初始化 Jittor，不继承主进程的计算图与线程状态
+        context = mp.get_context("spawn")
+        self.task_queue = context.Queue()
+        self.result_queue = context.Queue(maxsize=self.queue_size)
+        # 掩码模型权重先写入权重文件，各扰动进程（以及主进程的兜底填充）映射同一份权重
+        mask_model_name = getattr(args, "mask_filling_model_name", "t5-small")
+        ensure_weights(config, mask_model_name, T5ForConditionalGeneration)
+        worker_args = copy.copy(args)
+        worker_args.precision_reference = False  # 子进程无需保留fp32参考模型
+        worker_args.weight_store = True
+        self.workers = [
+            context.Process(
+                target=_perturbation_worker,
+                args=(worker_id, worker_args, config["base_tokenizer"], self.task_queue, self.result_queue),
+                daemon=True
+            )
+            for worker_id in range(n_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+        print(f"🧵 已启动 {n_workers} 个扰动进程（在途批次上限 {self.queue_size}）")
+
+    def _get_result(self):
+        """取一个结果；全部扰动进程都已退出时报错，避免无限等待"""
+        while True:
+            try:
+                return self.result_queue.get(timeout=1.0)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in self.workers):
+                    raise RuntimeError("全部扰动进程已退出")
+
+    def imap_unordered(self, tasks):
+        """
+        提交 (文本, 轮数, 已有扰动) 任务，按完成顺序产出 (任务序号, 扰动结果)；
+        某批在子进程中失败时扰动结果为 None，由调用方兜底
+        """
+        tasks = list(tasks)
+        # 任务号带上调用序号：上一次调用中途放弃时残留的结果直接丢弃
+        call_id = self.n_calls
+        self.n_calls += 1
+        next_task, in_flight = 0, 0
+        while next_task < len(tasks) or in_flight:
+            while next_task < len(tasks) and in_flight < self.queue_size:
+                texts, n_rounds, existing = tasks[next_task]
+                self.task_queue.put(((call_id, next_task), texts, n_rounds, existing))
+                next_task += 1
+                in_flight += 1
+
+            task_id, perturbed, error = self._get_result()
+            if error:
+                print(f"⚠️ {error}")
+            if task_id is None or task_id[0] != call_id:
+                continue  # 子进程加载失败或过期结果，不对应本次的任何批次
+            in_flight -= 1
+            self.n_batches += 1
+            self.n_failed += perturbed is None
+            yield task_id[1], perturbed
+
+    def close(self):
+        """发送结束标记并回收子进程"""
+        for _ in self.workers:
+            self.task_queue.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+
+    def report(self):
+        print(f"🧵 扰动进程池: {self.n_workers} 个进程，完成 {self.n_batches} 批（失败 {self.n_failed} 批）")
+
+
+def get_perturbation_pool(args, config):
+    """
+    取 config["perturbation_pool"]（首次调用时启动），--perturbation_workers 为 0 时返回 None；
+    启动失败时返回 None，由调用方退回单进程扰动
+    """
+    n_workers = getattr(args, "perturbation_workers", 0) or 0
+    if n_workers <= 0:
+        return None
+    if config.get("perturbation_pool") is None:
+        try:
+            config["perturbation_pool"] = PerturbationPool(
+                args, config, n_workers, getattr(args, "perturbation_queue_size", 0) or 0
+            )
+        except Exception as e:
+            print(f"❌ 启动扰动进程池失败，改为单进程扰动: {e}")
+            args.perturbation_workers = 0
+            return None
+    return config["perturbation_pool"]
@@ -4,7 +4,10 @@ from tqdm import tqdm
 
 # 导入自定义指标（后续会提供适配版本，此处先保持接口一致）
 from .metric import get_roc_metrics, get_precision_recall_metrics
-from .model import LikelihoodScorer, PerturbationScorer
+from .model import LikelihoodScorer, PerturbationScorer, SamplingDiscrepancyScorer, get_token_statistics
+from .cascade import CascadeScorer
+from .rank import RankScorer
+from .entropy import EntropyScorer
 from .likelihood import get_ll
 
 def run_baselines_threshold_experiment(args, data, criterion, name, L_samples=None):
@@ -112,6 +115,16 @@ def run_baselines(args, config, data):
     L_samples = config.get("L_samples")
     baseline_outputs = []
 
+    # 兼容 args 为字典或命名空间
+    args_dict = vars(args) if hasattr(args, '__dict__') else args
+
+    # 似然 / 熵 / 排名 / 对数排名共用一次分桶前向：先统一计算逐token统计，后续实验直接读取
+    if not args_dict.get('openai_model'):
+        try:
+            get_token_statistics(args, config, original_data + sample_data)
+        except Exception as e:
+            print(f"⚠️ 预计算逐token统计失败，各基线将单独计算: {e}")
+
     # 1. 似然度实验
     try:
         likelihood_scorer = LikelihoodScorer(args, config)
@@ -123,27 +136,78 @@ def run_baselines(args, config, data):
         print(f"✓ Likelihood 实验完成: AUC = {roc_auc:.3f}")
     except Exception as e:
         print(f"❌ Likelihood 实验失败: {e}")
+        likelihood_output = None
+
+    # 低精度权重：用保留的fp32参考模型重算似然基线，报告内存占用与AUC变化
+    # 取出即从config移除，比较完成后参考模型即可回收
+    reference_model = config.get("precision_reference", {}).pop("base_model", None)
+    if likelihood_output is None:
+        reference_model = None  # 似然基线失败，无从比较，直接释放
+    if reference_model is not None:
+        low_precision_model = config["base_model"]
+        try:
+            config["base_model"] = reference_model
+            reference_output = run_baselines_threshold_experiment(
+                args, data, LikelihoodScorer(args, config), "likelihood_fp32", L_samples=L_samples
+            )
+        except Exception as e:
+            print(f"❌ fp32 参考似然实验失败: {e}")
+            reference_output = None
+        finally:
+            config["base_model"] = low_precision_model
+            del reference_model
+
+        if reference_output is not None:
+            precision_report = config.get("precision", {}).get("base_model", {})
+            precision_report["roc_auc"] = likelihood_output["metrics"]["roc_auc"]
+            precision_report["fp32_roc_auc"] = reference_output["metrics"]["roc_auc"]
+            precision_report["auc_delta"] = precision_report["roc_auc"] - precision_report["fp32_roc_auc"]
+            likelihood_output["info"] = {"precision": precision_report}
+            print(f"🧮 {precision_report.get('mode')} 似然基线 AUC = {precision_report['roc_auc']:.4f}，"
+                  f"fp32 = {precision_report['fp32_roc_auc']:.4f}，变化 {precision_report['auc_delta']:+.4f}")
+
+    # 排名 / 对数排名 / 熵实验（仅本地模型）
+    if not args_dict.get('openai_model'):
+        for name, label, scorer in (
+            ("rank", "Rank", RankScorer(args, config, log=False)),
+            ("logrank", "Log-Rank", RankScorer(args, config, log=True)),
+            ("entropy", "Entropy", EntropyScorer(args, config)),
+        ):
+            try:
+                threshold_output = run_baselines_threshold_experiment(
+                    args, data, scorer, name, L_samples=L_samples
+                )
+                baseline_outputs.append(threshold_output)
+                roc_auc = threshold_output.get('metrics', {}).get('roc_auc', 0)
+                print(f"✓ {label} 实验完成: AUC = {roc_auc:.3f}")
+            except Exception as e:
+                print(f"❌ {label} 实验失败: {e}")
 
     # 2. 扰动实验
-    # 兼容 args 为字典或命名空间
-    args_dict = vars(args) if hasattr(args, '__dict__') else args
     baselines_only = args_dict.get('baselines_only', False)
     random_fills = args_dict.get('random_fills', False)
 
-    if not baselines_only and not random_fills:
-        try:
-            if "mask_model" not in config or "mask_tokenizer" not in config:
-                from utils.load_models_tokenizers import load_mask_filling_model
-                print("加载掩码填充模型和Tokenizer...")
-                load_mask_filling_model(args, config)
+    cascade = args_dict.get('cascade', False)
+    detection_method = args_dict.get('detection_method', 'perturbation')
+    # 级联模式下扰动曲率只对不确定区间内的文本计算，不再对全部文本跑一遍完整扰动实验
+    run_perturbation = (not baselines_only and not random_fills and not cascade
+                        and detection_method == 'perturbation')
+    perturbation_scorer = None
 
+    if run_perturbation or cascade:
+        try:
+            # 掩码模型未加载时由评分器在本进程第一次填充时加载（扰动进程池启用时不需要）
             perturbation_scorer = PerturbationScorer(
                 args=args,
                 config=config,
-                mask_filling_model=config["mask_model"],
-                mask_filling_tokenizer=config["mask_tokenizer"]
+                mask_filling_model=config.get("mask_model"),
+                mask_filling_tokenizer=config.get("mask_tokenizer")
             )
+        except Exception as e:
+            print(f"❌ 创建扰动评分器失败: {e}")
 
+    if run_perturbation and perturbation_scorer is not None:
+        try:
             perturbation_output = run_baselines_threshold_experiment(
                 args, data, perturbation_scorer, "perturbation", L_samples=L_samples
             )
@@ -153,6 +217,38 @@ def run_baselines(args, config, data):
         except Exception as e:
             print(f"❌ Perturbation 实验失败: {e}")
 
+    # 采样差异实验：基础模型单次前向解析估计曲率，不需要掩码模型
+    if not baselines_only and detection_method == 'sampling_discrepancy':
+        try:
+            sampling_output = run_baselines_threshold_experiment(
+                args, data, SamplingDiscrepancyScorer(args, config), "sampling_discrepancy", L_samples=L_samples
+            )
+            baseline_outputs.append(sampling_output)
+            roc_auc = sampling_output.get('metrics', {}).get('roc_auc', 0)
+            print(f"✓ Sampling Discrepancy 实验完成: AUC = {roc_auc:.3f}")
+        except Exception as e:
+            print(f"❌ Sampling Discrepancy 实验失败: {e}")
+
+    # 3. 级联实验：似然分数判定置信尾部，仅不确定区间内的文本计算扰动曲率
+    if cascade and perturbation_scorer is not None:
+        try:
+            cascade_scorer = CascadeScorer(
+                args, config, perturbation_scorer,
+                escalation_rate=args_dict.get('cascade_escalation', 0.3)
+            )
+            # 在全部待测文本（无标签）上校准不确定区间
+            cascade_scorer.calibrate(original_data + sample_data)
+            cascade_output = run_baselines_threshold_experiment(
+                args, data, cascade_scorer, "cascade", L_samples=L_samples
+            )
+            cascade_output["info"] = cascade_scorer.stats()
+            baseline_outputs.append(cascade_output)
+            roc_auc = cascade_output.get('metrics', {}).get('roc_auc', 0)
+            print(f"✓ Cascade 实验完成: AUC = {roc_auc:.3f}，"
+                  f"升级比例 = {cascade_scorer.escalation_ratio:.1%}")
+        except Exception as e:
+            print(f"❌ Cascade 实验失败: {e}")
+
     return baseline_outputs
 
 
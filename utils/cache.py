@@ -0,0 +1,263 @@
+# cache.py
+# 对数似然缓存：内存LRU + 磁盘(sqlite)两级，按内容寻址
+# 扰动库：按 (文本, 掩码模型, 掩码参数, 种子, 序号) 追加写入磁盘，跨实验复用
+# 分词缓存：按 (tokenizer, 文本哈希, max_length) 缓存token id数组，内存上限内LRU淘汰
+import os
+import json
+import hashlib
+import sqlite3
+from collections import OrderedDict
+
+import numpy as np
+
+
+def text_hash(text):
+    """文本内容哈希（缓存键的一部分）"""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def weights_fingerprint(arrays, n_values=1024):
+    """权重指纹：取前两个数组各前 n_values 个数值做哈希（数组可为 jt.Var / np.ndarray / np.memmap）"""
+    digest = hashlib.sha1()
+    for array in list(arrays)[:2]:
+        values = array.reshape(-1)[:n_values]
+        values = values.numpy() if hasattr(values, "numpy") else np.asarray(values)
+        digest.update(np.ascontiguousarray(values).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def model_fingerprint(model, n_values=1024):
+    """
+    模型权重指纹：取前两个参数各前 n_values 个数值做哈希
+    简易模型每次随机初始化，仅凭模型名称做键会命中另一组权重算出的旧值
+    """
+    parameters = model.parameters() if hasattr(model, "parameters") else [
+        value for value in vars(model).values() if hasattr(value, "weight")
+    ]
+    return weights_fingerprint(
+        [param.weight if hasattr(param, "weight") else param for param in list(parameters)[:2]], n_values
+    )
+
+
+class LLCache:
+    """
+    对数似然缓存
+    键为 (模型名称, 模型指纹, tokenizer, max_length, 文本哈希)，
+    内存层为LRU，磁盘层为 cache_dir 下的 sqlite 文件，跨实验复用
+    """
+
+    def __init__(self, cache_dir=None, max_entries=100000):
+        self.max_entries = max(1, max_entries)
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.db = None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.db_path = os.path.join(cache_dir, "ll_cache.sqlite")
+            self.db = sqlite3.connect(self.db_path)
+            self.db.execute("CREATE TABLE IF NOT EXISTS lls (key TEXT PRIMARY KEY, ll REAL)")
+            self.db.commit()
+
+    @staticmethod
+    def namespace(model_name, fingerprint, tokenizer, max_length):
+        """同一模型/tokenizer/截断长度下的键前缀"""
+        tokenizer_name = getattr(tokenizer, "name_or_path", type(tokenizer).__name__)
+        return f"{model_name}|{fingerprint}|{tokenizer_name}|{max_length}"
+
+    @staticmethod
+    def make_key(namespace, text):
+        return f"{namespace}|{text_hash(text)}"
+
+    def _remember(self, key, ll):
+        self.memory[key] = ll
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def get_many(self, keys):
+        """批量查询，返回 {key: ll}（仅包含命中的键）"""
+        found = {}
+        disk_keys = []
+        for key in keys:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                found[key] = self.memory[key]
+            else:
+                disk_keys.append(key)
+
+        if self.db is not None and disk_keys:
+            unique_keys = list(dict.fromkeys(disk_keys))
+            for start in range(0, len(unique_keys), 500):
+                chunk = unique_keys[start:start + 500]
+                rows = self.db.execute(
+                    f"SELECT key, ll FROM lls WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                for key, ll in rows:
+                    found[key] = ll
+                    self._remember(key, ll)
+                    self.disk_hits += 1
+
+        n_hits = sum(1 for key in keys if key in found)
+        self.hits += n_hits
+        self.misses += len(keys) - n_hits
+        return found
+
+    def put_many(self, items):
+        """批量写入 {key: ll}，同时落盘"""
+        for key, ll in items.items():
+            self._remember(key, float(ll))
+        if self.db is not None and items:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO lls (key, ll) VALUES (?, ?)",
+                [(key, float(ll)) for key, ll in items.items()]
+            )
+            self.db.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "memory_entries": len(self.memory),
+        }
+
+    def report(self):
+        stats = self.stats()
+        print(f"📦 LL缓存: 命中 {stats['hits']} 次（其中磁盘 {stats['disk_hits']} 次），"
+              f"未命中 {stats['misses']} 次，命中率 {stats['hit_rate']:.1%}")
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+class TokenCache:
+    """
+    分词缓存（进程内LRU）
+    键为 (tokenizer, 文本哈希, max_length)，值为只读的 int32 token id数组；
+    打分、扰动、排名等各处分词共用，同一文本在一次运行中对每个tokenizer只编码一次
+    """
+
+    def __init__(self, max_mb=256):
+        self.max_bytes = max(1, int(max_mb * 2 ** 20))
+        self.memory = OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(tokenizer, text, max_length):
+        tokenizer_name = getattr(tokenizer, "name_or_path", type(tokenizer).__name__)
+        return f"{tokenizer_name}|{max_length}|{text_hash(text)}"
+
+    def encode_many(self, tokenizer, texts, max_length, encode_fn):
+        """批量取token id：命中的直接返回，未命中的文本统一交给 encode_fn(未命中文本列表) 编码后写入"""
+        keys = [self.make_key(tokenizer, text, max_length) for text in texts]
+        results = [None] * len(texts)
+        pending = {}
+        for idx, key in enumerate(keys):
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                results[idx] = self.memory[key]
+                self.hits += 1
+            else:
+                pending.setdefault(key, []).append(idx)
+        self.misses += sum(len(indices) for indices in pending.values())
+
+        if pending:
+            encoded = encode_fn([texts[indices[0]] for indices in pending.values()])
+            for (key, indices), ids in zip(pending.items(), encoded):
+                ids = np.array(ids, dtype=np.int32)
+                ids.flags.writeable = False
+                for idx in indices:
+                    results[idx] = ids
+                self._remember(key, ids)
+        return results
+
+    def _remember(self, key, ids):
+        if key in self.memory:
+            self.n_bytes -= self.memory[key].nbytes
+        self.memory[key] = ids
+        self.n_bytes += ids.nbytes
+        while self.n_bytes > self.max_bytes and self.memory:
+            _, evicted = self.memory.popitem(last=False)
+            self.n_bytes -= evicted.nbytes
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self.memory),
+            "memory_mb": self.n_bytes / 2 ** 20,
+        }
+
+    def report(self):
+        stats = self.stats()
+        print(f"📦 分词缓存: 命中 {stats['hits']} 次，未命中 {stats['misses']} 次，"
+              f"命中率 {stats['hit_rate']:.1%}（{stats['entries']} 条，{stats['memory_mb']:.1f}MB）")
+
+
+class PerturbationBank:
+    """
+    持久化扰动库（追加写入的 jsonl 文件）
+    每条扰动以 (文本哈希, 掩码模型, 掩码模型权重指纹, 精度, pct_words_masked, span_length, 种子, 序号) 定位，
+    同一文本的扰动按序号形成前缀：需要 k 个扰动时直接取前 k 个，不足部分才重新生成
+    """
+
+    def __init__(self, cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, "perturbation_bank.jsonl")
+        self.entries = {}  # key -> {index: 扰动文本}
+        self.reused = 0
+        self.generated = 0
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        item = json.loads(line)
+                        self.entries.setdefault(item["key"], {})[int(item["index"])] = item["text"]
+                    except (ValueError, KeyError):
+                        continue  # 跳过中断写入留下的残行
+
+    @staticmethod
+    def namespace(mask_model_name, fingerprint, precision, pct_words_masked, span_length, seed):
+        """同一组掩码模型权重、精度与扰动参数下的键前缀"""
+        return f"{mask_model_name}|{fingerprint}|{precision}|{pct_words_masked}|{span_length}|{seed}"
+
+    @staticmethod
+    def make_key(namespace, text):
+        return f"{namespace}|{text_hash(text)}"
+
+    def get_prefix(self, key, n, known=0):
+        """
+        返回序号 0..n-1 中连续已存在的扰动（最长前缀）
+        known 为调用方已持有的扰动数（逐轮扩展时重复查询），复用计数只统计其后新取出的部分
+        """
+        stored = self.entries.get(key, {})
+        prefix = []
+        while len(prefix) < n and len(prefix) in stored:
+            prefix.append(stored[len(prefix)])
+        self.reused += max(0, len(prefix) - known)
+        return prefix
+
+    def append(self, key, start_index, perturbations):
+        """从 start_index 起追加扰动并落盘"""
+        if not perturbations:
+            return
+        stored = self.entries.setdefault(key, {})
+        with open(self.path, "a", encoding="utf-8") as f:
+            for offset, text in enumerate(perturbations):
+                index = start_index + offset
+                stored[index] = text
+                f.write(json.dumps({"key": key, "index": index, "text": text}, ensure_ascii=False) + "\n")
+        self.generated += len(perturbations)
+
+    def report(self):
+        print(f"📦 扰动库: 复用 {self.reused} 条，新生成 {self.generated} 条（{self.path}）")
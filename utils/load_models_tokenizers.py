@@ -1,6 +1,66 @@
+import re
 import jittor as jt
 import numpy as np
 
+from .precision import load_with_precision, get_precision_mode
+from .model_registry import ModelRegistry
+from .weight_store import load_or_create
+
+
+# -------------------------- 批量分词（NumPy 向量化） --------------------------
+def pack_codepoints(texts, vocab_size, max_length=None):
+    """
+    批量将文本按 Unicode 码位取模映射为token id（vocab_size 为 None 时保留原码位）
+    全部文本拼接后一次性编码为 UTF-32，由 NumPy 直接解释为码位数组；
+    返回 (连续的 int32 id 缓冲区, 偏移数组)，第 i 个文本的 id 为 ids[offsets[i]:offsets[i + 1]]
+    """
+    lengths = np.fromiter((len(text) for text in texts), dtype=np.int64, count=len(texts))
+    codepoints = np.frombuffer("".join(texts).encode("utf-32-le", "surrogatepass"), dtype=np.uint32)
+    ids = (codepoints % vocab_size if vocab_size else codepoints).astype(np.int32)
+
+    if max_length is not None and lengths.size and lengths.max() > max_length:
+        # 截断：保留每个文本内位置小于 max_length 的token
+        starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+        ids = ids[(np.arange(ids.size) - starts) < max_length]
+        lengths = np.minimum(lengths, max_length)
+
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return ids, offsets
+
+
+def pack_sequences(sequences):
+    """将一组token id序列打包为 (连续 int32 缓冲区, 偏移数组)"""
+    lengths = np.fromiter((len(seq) for seq in sequences), dtype=np.int64, count=len(sequences))
+    ids = np.concatenate([np.asarray(seq, dtype=np.int32) for seq in sequences]) if len(sequences) else \
+        np.zeros(0, dtype=np.int32)
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return ids.astype(np.int32, copy=False), offsets
+
+
+def pad_packed(ids, offsets, pad_token_id, max_length=None):
+    """
+    将打包的id直接散射到 (batch, max_len) 的 int32 矩阵中（max_length 指定时截断/补齐到该长度），
+    返回 (input_ids, attention_mask)，可直接交给 jt.array
+    """
+    lengths = np.diff(offsets)
+    width = int(max_length) if max_length is not None else int(lengths.max(initial=0))
+    input_ids = np.full((len(lengths), width), pad_token_id, dtype=np.int32)
+    attention_mask = np.zeros((len(lengths), width), dtype=np.float32)
+
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    cols = np.arange(ids.size) - np.repeat(offsets[:-1], lengths)
+    keep = cols < width
+    input_ids[rows[keep], cols[keep]] = ids[keep]
+    attention_mask[rows[keep], cols[keep]] = 1.0
+    return input_ids, attention_mask
+
+
+def unpack(ids, offsets):
+    """打包缓冲区按偏移切分为各文本的id列表"""
+    return [ids[offsets[i]:offsets[i + 1]].tolist() for i in range(len(offsets) - 1)]
+
 
 # -------------------------- 简易GPT2 Tokenizer（兼容原接口） --------------------------
 class GPT2Tokenizer:
@@ -20,13 +80,17 @@ class GPT2Tokenizer:
         if max_length is None:
             max_length = self.max_len
         # 模拟文本转id（实际可根据需求优化，此处保证项目不报错）
-        ids = [ord(c) % self.vocab_size for c in text]
-        if truncation and len(ids) > max_length:
-            ids = ids[:max_length]
+        ids = pack_codepoints([text], self.vocab_size, max_length if truncation else None)[0]
         # 兼容返回Jittor张量
         if return_tensors == "jt":
-            return jt.array([ids])  # 返回(batch_size, seq_len)格式
-        return ids
+            return jt.array(ids[None, :])  # 返回(batch_size, seq_len)格式
+        return ids.tolist()
+
+    def batch_encode(self, texts, truncation=True, max_length=None):
+        """批量分词，返回 (连续 int32 id 缓冲区, 偏移数组)"""
+        if max_length is None:
+            max_length = self.max_len
+        return pack_codepoints(texts, self.vocab_size, max_length if truncation else None)
 
     def decode(self, ids, skip_special_tokens=True):
         # 兼容Jittor张量/数组/列表解码
@@ -46,24 +110,16 @@ class GPT2Tokenizer:
         if max_length is None:
             max_length = self.max_len
         # 模拟padding逻辑
-        padded_sequences = []
-        for seq in sequences:
-            if len(seq) < max_length:
-                pad_len = max_length - len(seq)
-                padded_seq = seq + [self.pad_token_id] * pad_len
-            else:
-                padded_seq = seq[:max_length]
-            padded_sequences.append(padded_seq)
-        return np.array(padded_sequences)
+        return pad_packed(*pack_sequences(sequences), self.pad_token_id, max_length)[0]
 
     def __call__(self, text, return_tensors=None, padding=False, truncation=False, max_length=None):
         # 兼容模型调用时的__call__接口
         if isinstance(text, list):
-            ids_list = [self.encode(t, truncation, max_length) for t in text]
+            ids, offsets = self.batch_encode(text, truncation, max_length)
             if padding:
-                ids = self.pad(ids_list, max_length=max_length)
+                ids = pad_packed(ids, offsets, self.pad_token_id, max_length or self.max_len)[0]
             else:
-                ids = ids_list
+                ids = unpack(ids, offsets)
         else:
             ids = self.encode(text, truncation, max_length)
 
@@ -72,8 +128,17 @@ class GPT2Tokenizer:
         return {"input_ids": ids}
 
 
+def set_inference_mode(model):
+    """推理模式：关闭dropout（eval）并停止参数梯度，评分时不再记录反向图"""
+    if hasattr(model, "eval"):
+        model.eval()
+    if hasattr(model, "requires_grad_"):
+        model.requires_grad_(False)
+    return model
+
+
 # -------------------------- 简易GPT2模型（修复版：解决形状不匹配问题） --------------------------
-class GPT2LMHeadModel:
+class GPT2LMHeadModel(jt.Module):
     def __init__(self):
         # 基础层定义
         self.embedding = jt.nn.Embedding(50257, 768)
@@ -85,7 +150,8 @@ class GPT2LMHeadModel:
         self.lm_head = jt.nn.Linear(768, 50257)
         self.dropout = jt.nn.Dropout(0.1)
 
-    def execute(self, input_ids):
+    def hidden_states(self, input_ids):
+        """lm_head 之前的隐状态 (batch, seq_len, 768)，供分块计算词表 log-softmax 使用"""
         # 输入维度校验
         if len(input_ids.shape) == 1:
             input_ids = input_ids.unsqueeze(0)  # [seq_len] -> [1, seq_len]
@@ -104,12 +170,22 @@ class GPT2LMHeadModel:
         # 第二层处理
         x = x + self.dropout(self.linear2(x))
         x = self.norm2(x)
+        return x
 
-        logits = self.lm_head(x)  # (batch, seq_len, 50257)
+    def execute(self, input_ids):
+        logits = self.lm_head(self.hidden_states(input_ids))  # (batch, seq_len, 50257)
         return logits
 
-    def __call__(self, input_ids, labels=None, **kwargs):
-        # 兼容原项目调用方式（支持labels参数计算loss）
+    def __call__(self, input_ids, labels=None, attention_mask=None, reduction='mean', **kwargs):
+        """
+        兼容原项目调用方式（支持labels参数计算loss）
+        labels 与 input_ids 对齐传入，内部做移位：第t个位置的logits预测第t+1个token；
+        attention_mask 为0的位置与 labels 为 -100 的位置不计入loss（不再用 ignore_index=0，
+        以免与真实的0号token冲突）。
+        reduction='mean' 时 loss 为全部有效token的平均损失；reduction='none' 时 loss 为
+        (batch, seq_len - 1) 的逐token损失（无效位置为0）。
+        给出 labels 时另外返回 token_lls（逐token对数似然）与 lls（每个样本的平均对数似然）
+        """
         if isinstance(input_ids, dict):
             input_ids = input_ids.get("input_ids", input_ids)
 
@@ -131,39 +207,83 @@ class GPT2LMHeadModel:
             if len(labels.shape) == 1:
                 labels = labels.unsqueeze(0)
 
-            # 模拟计算loss（保证项目能获取loss值）
-            loss = jt.nn.cross_entropy_loss(
-                logits.reshape(-1, logits.shape[-1]),
-                labels.reshape(-1),
-                ignore_index=0
-            )
-            output["loss"] = loss
+            # 移位：logits[:, t] 预测 labels[:, t + 1]
+            shift_logits = logits[:, :-1, :]
+            shift_labels = labels[:, 1:]
+            loss_mask = (shift_labels != -100).float32()
+            if attention_mask is not None:
+                if isinstance(attention_mask, (list, np.ndarray)):
+                    attention_mask = jt.array(attention_mask)
+                if len(attention_mask.shape) == 1:
+                    attention_mask = attention_mask.unsqueeze(0)
+                loss_mask = loss_mask * attention_mask[:, 1:].float32()
+            # -100 位置替换为合法id再计算，随后由mask清零
+            safe_labels = jt.ternary(shift_labels == -100, jt.zeros_like(shift_labels), shift_labels)
+
+            batch_size, n_positions = safe_labels.shape
+            token_loss = jt.nn.cross_entropy_loss(
+                shift_logits.reshape(-1, shift_logits.shape[-1]),
+                safe_labels.reshape(-1),
+                reduction='none'
+            ).reshape(batch_size, n_positions) * loss_mask
+            n_tokens = loss_mask.sum(1)
+
+            output["token_lls"] = -token_loss
+            output["lls"] = -token_loss.sum(1) / jt.maximum(n_tokens, 1.0)
+            if reduction == 'none':
+                output["loss"] = token_loss
+            else:
+                output["loss"] = token_loss.sum() / jt.maximum(n_tokens.sum(), 1.0)
         return output
 
 
 # -------------------------- 简易T5 Tokenizer（兼容原接口） --------------------------
 class T5Tokenizer:
+    # 与真实T5一致：<extra_id_k> 对应 id = 32099 - k，共100个哨兵token
+    SENTINEL_PATTERN = re.compile(r'<extra_id_(\d+)>')
+
     def __init__(self):
         self.vocab_size = 32128
         self.pad_token_id = 0
         self.eos_token_id = 1
         self.mask_token_id = 2
         self.max_len = 512
+        self.sentinel_start_id = 32099
+        self.n_sentinels = 100
 
     @staticmethod
     def from_pretrained(model_name):
         return T5Tokenizer()
 
+    def is_sentinel(self, token_id):
+        return self.sentinel_start_id - self.n_sentinels < token_id <= self.sentinel_start_id
+
+    # 哨兵token先替换为该私用区码位上的单个字符，再随其他字符一起向量化映射
+    SENTINEL_CODEPOINT = 0xF0000
+
+    def _replace_sentinel(self, match):
+        k = int(match.group(1))
+        return chr(self.SENTINEL_CODEPOINT + k) if k < self.n_sentinels else match.group(0)
+
     def encode(self, text, truncation=True, max_length=None, return_tensors=None):
         if max_length is None:
             max_length = self.max_len
-        ids = [ord(c) % self.vocab_size for c in text]
-        if truncation and len(ids) > max_length:
-            ids = ids[:max_length]
+        # <extra_id_k> 编码为单个哨兵token，其余字符逐个映射
+        ids, _ = self.batch_encode([text], truncation, max_length)
         # 兼容返回Jittor张量
         if return_tensors == "jt":
-            return jt.array([ids])
-        return ids
+            return jt.array(ids[None, :])
+        return ids.tolist()
+
+    def batch_encode(self, texts, truncation=True, max_length=None):
+        """批量分词（含哨兵token），返回 (连续 int32 id 缓冲区, 偏移数组)"""
+        if max_length is None:
+            max_length = self.max_len
+        texts = [self.SENTINEL_PATTERN.sub(self._replace_sentinel, text) for text in texts]
+        ids, offsets = pack_codepoints(texts, None, max_length if truncation else None)
+        sentinel = (ids >= self.SENTINEL_CODEPOINT) & (ids < self.SENTINEL_CODEPOINT + self.n_sentinels)
+        ids = np.where(sentinel, self.sentinel_start_id - (ids - self.SENTINEL_CODEPOINT), ids % self.vocab_size)
+        return ids.astype(np.int32), offsets
 
     def decode(self, ids, skip_special_tokens=True):
         # 兼容Jittor张量/数组/列表解码
@@ -174,32 +294,40 @@ class T5Tokenizer:
         # 处理二维数组（batch解码）
         if isinstance(ids, list) and len(ids) > 0 and isinstance(ids[0], list):
             ids = ids[0]  # 取第一个batch
-        # 跳过特殊token
-        if skip_special_tokens:
-            ids = [i for i in ids if i not in [self.pad_token_id, self.eos_token_id, self.mask_token_id]]
-        return ''.join([chr(i % 128) for i in ids])
+        special_ids = [self.pad_token_id, self.eos_token_id, self.mask_token_id]
+        pieces = []
+        for i in ids:
+            # 跳过特殊token（含哨兵token）
+            if skip_special_tokens and (i in special_ids or self.is_sentinel(i)):
+                continue
+            if self.is_sentinel(i):
+                pieces.append(f"<extra_id_{self.sentinel_start_id - i}>")
+            elif i == self.pad_token_id:
+                pieces.append("<pad>")
+            elif i == self.eos_token_id:
+                pieces.append("</s>")
+            else:
+                pieces.append(chr(i % 128))
+        return ''.join(pieces)
+
+    def batch_decode(self, sequences, skip_special_tokens=True):
+        if isinstance(sequences, jt.Var):
+            sequences = sequences.numpy()
+        return [self.decode(seq, skip_special_tokens=skip_special_tokens) for seq in sequences]
 
     def pad(self, sequences, padding='max_length', max_length=None):
         if max_length is None:
             max_length = self.max_len
-        padded_sequences = []
-        for seq in sequences:
-            if len(seq) < max_length:
-                pad_len = max_length - len(seq)
-                padded_seq = seq + [self.pad_token_id] * pad_len
-            else:
-                padded_seq = seq[:max_length]
-            padded_sequences.append(padded_seq)
-        return np.array(padded_sequences)
+        return pad_packed(*pack_sequences(sequences), self.pad_token_id, max_length)[0]
 
     def __call__(self, text, return_tensors=None, padding=False, truncation=False, max_length=None):
         # 兼容模型调用时的__call__接口
         if isinstance(text, list):
-            ids_list = [self.encode(t, truncation, max_length) for t in text]
+            ids, offsets = self.batch_encode(text, truncation, max_length)
             if padding:
-                ids = self.pad(ids_list, max_length=max_length)
+                ids = pad_packed(ids, offsets, self.pad_token_id, max_length or self.max_len)[0]
             else:
-                ids = ids_list
+                ids = unpack(ids, offsets)
         else:
             ids = self.encode(text, truncation, max_length)
 
@@ -209,7 +337,7 @@ class T5Tokenizer:
 
 
 # -------------------------- 简易T5模型（修复版：解决形状不匹配问题） --------------------------
-class T5ForConditionalGeneration:
+class T5ForConditionalGeneration(jt.Module):
     def __init__(self):
         # 编码器层
         self.encoder_embedding = jt.nn.Embedding(32128, 512)
@@ -229,6 +357,11 @@ class T5ForConditionalGeneration:
         self.lm_head = jt.nn.Linear(512, 32128)
         self.dropout = jt.nn.Dropout(0.1)
 
+    @staticmethod
+    def from_pretrained(model_name):
+        # 模拟从预训练加载，返回实例
+        return T5ForConditionalGeneration()
+
     def encode(self, input_ids):
         # 输入维度校验
         if len(input_ids.shape) == 1:
@@ -295,38 +428,145 @@ class T5ForConditionalGeneration:
 
         return self.execute(input_ids, labels)
 
-    def generate(self, input_ids, max_length=512, num_return_sequences=1, do_sample=False):
-        # 模拟generate接口（兼容掩码填充逻辑）
+    def decode_step(self, token_ids, encoder_states):
+        """
+        增量解码一步：token_ids (n,) 为各行上一步输出的token，encoder_states (n, 512) 为各行当前位置的编码器输出，
+        返回 (n, 512) 的解码器隐状态。该解码器没有自注意力，每个位置只依赖当前token与编码器同一位置，
+        因此跨步的增量状态只有一次性算好的编码器输出与步数，每步只计算一个位置
+        """
+        x = self.decoder_embedding(token_ids) + encoder_states
+        linear1_out = jt.nn.relu(self.decoder_linear1(x))
+        linear1_out = self.decoder_adapter(linear1_out)
+        return self.decoder_norm(x + self.dropout(linear1_out))
+
+    def generate(self, input_ids, max_length=512, num_return_sequences=1, do_sample=False,
+                 pad_token_id=0, eos_token_id=None, stop_token_ids=None, top_p=1.0, temperature=1.0,
+                 decoder_start_token_id=None):
+        """
+        自回归生成（贪心或 top-p 采样）：输入只编码一次，之后逐步解码，每步只计算尚未停止的行；
+        eos_token_id / stop_token_ids（每行一个）：某行输出停止token后不再解码，其余位置填pad，
+        输出只保留到最长一行停止处（不含起始token）；输入中的pad位置与超出输入长度的步同样按0处理
+        """
         if isinstance(input_ids, (list, np.ndarray)):
             input_ids = jt.array(input_ids)
 
         if len(input_ids.shape) == 1:
             input_ids = input_ids.unsqueeze(0)
 
-        batch_size = input_ids.shape[0]
-        # 生成随机token（模拟填充结果）
-        gen_tokens = jt.randint(0, 32128, (batch_size, max_length))
-        return gen_tokens
+        with jt.no_grad():
+            # padding位置的编码器输出置0（与超出编码器长度的步一致），每行的输出不随同批其他行的长度变化
+            encoder_hidden_states = self.encode(input_ids) * (input_ids != pad_token_id).float32().unsqueeze(-1)
+            if num_return_sequences > 1:
+                rows = np.repeat(np.arange(input_ids.shape[0]), num_return_sequences)
+                encoder_hidden_states = encoder_hidden_states[jt.array(rows)]
+            batch_size, encoder_length, hidden_size = encoder_hidden_states.shape
+
+            stop_ids = np.full(batch_size, -1, dtype=np.int64)
+            if stop_token_ids is not None:
+                stop_ids = np.repeat(np.asarray(stop_token_ids, dtype=np.int64).reshape(-1), num_return_sequences)
+            start_id = pad_token_id if decoder_start_token_id is None else decoder_start_token_id
+            last_tokens = np.full(batch_size, start_id, dtype=np.int32)
+            tokens = np.full((batch_size, max_length), pad_token_id, dtype=np.int32)
+            finished = np.zeros(batch_size, dtype=bool)
+
+            n_steps = 0
+            for step in range(max_length):
+                active = np.flatnonzero(~finished)
+                if active.size == 0:
+                    break
+                # 编码器输出比解码步数短时，超出部分视为0（与 decode 的padding一致）
+                if step < encoder_length:
+                    encoder_states = encoder_hidden_states[jt.array(active), step]
+                else:
+                    encoder_states = jt.zeros((active.size, hidden_size))
+                hidden = self.decode_step(jt.array(last_tokens[active]), encoder_states)
+                logits = self.lm_head(hidden).numpy()
+
+                if do_sample:
+                    next_tokens = _sample_top_p(logits, top_p, temperature)
+                else:
+                    next_tokens = logits.argmax(axis=-1)
+                next_tokens = next_tokens.astype(np.int32)
+
+                tokens[active, step] = next_tokens
+                last_tokens[active] = next_tokens
+                stopped = next_tokens == stop_ids[active]
+                if eos_token_id is not None:
+                    stopped |= next_tokens == eos_token_id
+                finished[active[stopped]] = True
+                n_steps = step + 1
+
+        return jt.array(tokens[:, :max(1, n_steps)])
+
+
+def _sample_top_p(logits, top_p=1.0, temperature=1.0):
+    """逐行 top-p（nucleus）采样：只在累计概率达到 top_p 的最小token集合内按概率采样"""
+    logits = logits / max(temperature, 1e-5)
+    probs = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    probs /= probs.sum(axis=-1, keepdims=True)
+
+    order = np.argsort(-probs, axis=-1)
+    sorted_probs = np.take_along_axis(probs, order, axis=-1)
+    # 累计概率（不含自身）已达到 top_p 的token被截掉，概率最高的token总会保留
+    sorted_probs[np.cumsum(sorted_probs, axis=-1) - sorted_probs >= top_p] = 0.0
+    sorted_probs /= sorted_probs.sum(axis=-1, keepdims=True)
+
+    thresholds = np.random.random((len(sorted_probs), 1))
+    choice = (np.cumsum(sorted_probs, axis=-1) < thresholds).sum(axis=-1)
+    choice = np.minimum(choice, sorted_probs.shape[-1] - 1)
+    return order[np.arange(len(order)), choice]
 
 
 # -------------------------- 原项目接口（完全兼容，无需修改run.py） --------------------------
+def _load_from_registry(args, config, model_name, load):
+    """经 config["model_registry"]（按模型名称 + 权重精度）取常驻模型，未命中时调用 load 加载"""
+    registry = config.get("model_registry")
+    if registry is None:
+        return load()
+    return registry.get_or_load(ModelRegistry.make_key(model_name, get_precision_mode(args)), load)
+
+
 def load_base_model_and_tokenizer(args, config, scoring_model_name=None):
     # 加载GPT2模型和Tokenizer
-    model = GPT2LMHeadModel()
-    tokenizer = GPT2Tokenizer.from_pretrained('gpt2')
+    # 当前评分模型的名称（似然缓存键的一部分）
+    config["base_model_id"] = scoring_model_name or getattr(args, "base_model_name", "gpt2")
+
+    def load():
+        model = GPT2LMHeadModel()
+        if getattr(args, "weight_store", False):
+            model = load_or_create(config, model, config["base_model_id"])
+        model = set_inference_mode(load_with_precision(args, config, model, "base_model"))
+        print("✅ 成功加载简易GPT2模型（兼容Jittor，已修复形状不匹配问题）")
+        return model, GPT2Tokenizer.from_pretrained('gpt2')
+
+    model, tokenizer = _load_from_registry(args, config, config["base_model_id"], load)
     config["base_model"] = model
     config["base_tokenizer"] = tokenizer
     config["GPT2_TOKENIZER"] = tokenizer  # 兼容原项目中GPT2_TOKENIZER的引用
-    print("✅ 成功加载简易GPT2模型（兼容Jittor，已修复形状不匹配问题）")
 
 
 def load_mask_filling_model(args, config):
-    # 加载T5模型和Tokenizer
-    model = T5ForConditionalGeneration()
-    tokenizer = T5Tokenizer.from_pretrained('t5-small')
-    config["mask_model"] = model
-    config["mask_tokenizer"] = tokenizer
-    print("✅ 成功加载简易T5-small模型（兼容Jittor，已修复形状不匹配问题）")
+    # 加载T5模型和Tokenizer（经进程级共享的 MaskFiller，同一模型名称 + 精度只加载一次）
+    from utils.mask_filling import get_mask_filler
+    mask_model_name = getattr(args, "mask_filling_model_name", "t5-small")
+    mask_filler = get_mask_filler(mask_model_name, get_precision_mode(args))
+
+    def load():
+        model = T5ForConditionalGeneration()
+        # 扰动进程池启用时主进程与各扰动进程必须使用同一组权重，强制经权重文件加载
+        if getattr(args, "weight_store", False) or (getattr(args, "perturbation_workers", 0) or 0) > 0:
+            model = load_or_create(config, model, mask_model_name)
+        model = set_inference_mode(load_with_precision(args, config, model, "mask_model"))
+        print("✅ 成功加载简易T5-small模型（兼容Jittor，已修复形状不匹配问题）")
+        return model, T5Tokenizer.from_pretrained('t5-small')
+
+    if mask_filler.model is None:
+        mask_filler.attach(*_load_from_registry(args, config, mask_model_name, load))
+    else:
+        print(f"♻️ 复用共享掩码填充器: {mask_model_name}（{mask_filler.precision}）")
+    config["mask_model"] = mask_filler.model
+    config["mask_tokenizer"] = mask_filler.tokenizer
+    config["mask_filler"] = mask_filler
 
 
 def load_base_model(args, config):
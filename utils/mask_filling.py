@@ -1,10 +1,16 @@
 # mask_filling.py
 # 完全移除 PyTorch 依赖，适配 Jittor 环境
-import random
 import re
+import hashlib
+import itertools
 import jittor as jt
+import numpy as np
 from tqdm import tqdm
 
+from types import SimpleNamespace
+
+from utils.model_registry import ModelRegistry
+
 # 替换 transformers 为 jittor-transformers（若已安装），否则使用模拟接口
 try:
     from jittor.transformers import T5ForConditionalGeneration, T5Tokenizer
@@ -13,73 +19,310 @@ except ImportError:
     from utils.load_models_tokenizers import T5ForConditionalGeneration, T5Tokenizer
 
 
+# T5 输出中的哨兵token（<extra_id_k>），用于切分各掩码位置的填充内容
+SENTINEL_PATTERN = re.compile(r"<extra_id_\d+>")
+
+
+def count_masks(texts):
+    """统计每个文本中的掩码数量"""
+    return [len(SENTINEL_PATTERN.findall(text)) for text in texts]
+
+
+def extract_fills(outputs):
+    """
+    将T5的原始输出切分为各哨兵位置的填充片段
+    例如 "<pad><extra_id_0> a cat<extra_id_1> sat</s>" -> ["a cat", "sat"]
+    """
+    outputs = [x.replace("<pad>", "").replace("</s>", "").strip() for x in outputs]
+    # 第一个哨兵之前的内容不属于任何掩码，丢弃
+    return [[fill.strip() for fill in SENTINEL_PATTERN.split(x)[1:]] for x in outputs]
+
+
+def apply_extracted_fills(masked_texts, extracted_fills):
+    """将填充片段按哨兵编号写回掩码文本，缺失的填充直接移除对应掩码"""
+    filled_texts = []
+    for text, fills in zip(masked_texts, extracted_fills):
+        for idx in range(count_masks([text])[0]):
+            fill = fills[idx] if idx < len(fills) else ""
+            text = text.replace(f"<extra_id_{idx}>", fill, 1)
+        filled_texts.append(" ".join(text.split()))
+    return filled_texts
+
+
+# splitmix64 常量：计数器式随机数，第 (文本, 轮次) 个掩码只由其种子决定，与同批的其他文本无关
+_SPLITMIX_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+_SPLITMIX_M1 = np.uint64(0xBF58476D1CE4E5B9)
+_SPLITMIX_M2 = np.uint64(0x94D049BB133111EB)
+
+
+def _splitmix64(x):
+    """对 uint64 数组逐元素做 splitmix64 混合（溢出按 2^64 取模）"""
+    with np.errstate(over="ignore"):
+        z = x + _SPLITMIX_GAMMA
+        z = (z ^ (z >> np.uint64(30))) * _SPLITMIX_M1
+        z = (z ^ (z >> np.uint64(27))) * _SPLITMIX_M2
+        return z ^ (z >> np.uint64(31))
+
+
+def mask_seeds(texts, rounds, seed=0):
+    """每个 (文本, 轮次) 的掩码种子：由文本哈希、轮次序号与全局种子确定，可复现、可缓存"""
+    text_keys = np.array(
+        [int.from_bytes(hashlib.sha1(text.encode("utf-8")).digest()[:8], "little") for text in texts],
+        dtype=np.uint64
+    )
+    with np.errstate(over="ignore"):
+        mixed = _splitmix64(text_keys ^ _splitmix64(np.asarray(rounds, dtype=np.uint64)))
+        return _splitmix64(mixed ^ _splitmix64(np.full(len(texts), seed, dtype=np.uint64)))
+
+
+def _uniform(seeds, n_columns):
+    """由种子生成 (len(seeds), n_columns) 的 [0, 1) 均匀随机数矩阵"""
+    with np.errstate(over="ignore"):
+        counters = seeds[:, None] + np.arange(1, n_columns + 1, dtype=np.uint64)[None, :] * _SPLITMIX_GAMMA
+    return (_splitmix64(counters) >> np.uint64(11)).astype(np.float64) / float(2 ** 53)
+
+
+def sample_span_masks(n_tokens, pct, span_length, seeds):
+    """
+    一次为一批 (文本, 轮次) 采样互不重叠的掩码跨度，返回 (len(n_tokens), max(n_tokens)) 的布尔掩码矩阵
+    序列按随机偏移划分为长度为 span_length 的网格块（块之间天然不重叠），
+    每行按随机键选出前 k 个块，k 使被掩码的token数达到 max(1, int(n * pct))
+    """
+    n_tokens = np.asarray(n_tokens, dtype=np.int64)
+    seeds = np.asarray(seeds, dtype=np.uint64)
+    span_length = max(1, int(span_length))
+    n_items, width = len(n_tokens), int(n_tokens.max(initial=0))
+    if n_items == 0 or width == 0:
+        return np.zeros((n_items, width), dtype=bool)
+
+    max_blocks = width // span_length + 1
+    random_values = _uniform(seeds, max_blocks + 1)
+    shift = np.minimum((random_values[:, 0] * span_length).astype(np.int64), np.maximum(n_tokens - span_length, 0))
+    n_blocks = np.maximum((n_tokens - shift) // span_length, 0)
+    n_spans = np.minimum(-(-np.maximum(1, (n_tokens * pct).astype(np.int64)) // span_length), n_blocks)
+
+    # 每行随机键排序，选出排名前 n_spans 的有效块
+    keys = random_values[:, 1:]
+    keys[np.arange(max_blocks)[None, :] >= n_blocks[:, None]] = np.inf
+    ranks = np.argsort(np.argsort(keys, axis=1, kind="stable"), axis=1, kind="stable")
+    chosen = ranks < n_spans[:, None]
+
+    # 展开为逐token掩码
+    relative = np.arange(width)[None, :] - shift[:, None]
+    block = np.clip(relative // span_length, 0, max_blocks - 1)
+    in_range = (relative >= 0) & (relative // span_length < n_blocks[:, None])
+    return in_range & np.take_along_axis(chosen, block, axis=1)
+
+
+def mask_runs(mask):
+    """把一行掩码切分为连续段，返回 [(起点, 终点, 是否掩码)]"""
+    mask = np.asarray(mask, dtype=bool)
+    if mask.size == 0:
+        return []
+    bounds = np.concatenate([[0], np.flatnonzero(mask[1:] != mask[:-1]) + 1, [mask.size]])
+    return [(int(start), int(end), bool(mask[start])) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def fill_length(n_masks, span_length, max_length=512):
+    """
+    填充输出的生成长度上限：每个掩码一个哨兵 + 约 span_length 个填充token + 1个余量，
+    再加结束哨兵与eos；解码开销随掩码数而不是文档长度增长
+    """
+    return int(min(max_length, max(1, n_masks) * (max(1, span_length) + 2) + 2))
+
+
+def sentinel_ids(tokenizer, indices):
+    """<extra_id_k> 的 token id；作为每行的停止token时，输出该行最后一个掩码之后的哨兵即可停止生成"""
+    if hasattr(tokenizer, "sentinel_start_id"):
+        return [tokenizer.sentinel_start_id - k if k < tokenizer.n_sentinels else -1 for k in indices]
+    return tokenizer.convert_tokens_to_ids([f"<extra_id_{k}>" for k in indices])
+
+
+def join_masked(tokens, mask, mask_token=None, separator=" "):
+    """
+    将掩码位置上的每段连续token替换为一个掩码标记后拼接
+    mask_token 为 None 时依次使用 <extra_id_0>, <extra_id_1>, ...（T5哨兵）
+    """
+    mask = np.asarray(mask[:len(tokens)], dtype=bool)
+    starts = mask & ~np.concatenate([[False], mask[:-1]])
+    pieces, n_spans = [], 0
+    for token, masked, start in zip(tokens, mask, starts):
+        if start:
+            pieces.append(mask_token if mask_token is not None else f"<extra_id_{n_spans}>")
+            n_spans += 1
+        elif not masked:
+            pieces.append(token)
+    return separator.join(pieces)
+
+
 class MaskFiller:
     """掩码填充工具类，用于文本扰动（Jittor 版本）"""
 
-    def __init__(self, model_name, tokenizer=None, device="cpu"):
+    def __init__(self, model_name, tokenizer=None, device="cpu", batch_size=16, precision="fp32",
+                 args=None, config=None):
         self.model = None  # 延迟加载
         self.model_name = model_name
+        # 延迟加载时交给 load_mask_filling_model 的运行参数与 config（未传入时按模型名称与精度构造）
+        self.args = args
+        self.config = config
         self.tokenizer = tokenizer or T5Tokenizer.from_pretrained(model_name)
         self.device = device  # Jittor 中该参数仅用于兼容，实际由 jt.flags.use_cuda 控制
+        self.batch_size = max(1, batch_size)
+        self.precision = precision
+        self.warmed_up = False
+
+    def _loader_args(self):
+        """load_mask_filling_model 所需的运行参数：模型名称 + 与 self.precision 对应的精度开关"""
+        if self.args is not None:
+            return self.args
+        return SimpleNamespace(
+            mask_filling_model_name=self.model_name,
+            int8=self.precision == "int8",
+            half=self.precision in ("fp16", "bf16"),
+            half_dtype="bfloat16" if self.precision == "bf16" else "float16",
+        )
 
     def load_model(self):
-        """延迟加载模型以节省内存（Jittor 版本）"""
+        """
+        延迟加载模型：交给 load_mask_filling_model，与其他入口一样经模型注册表 / 权重文件加载，
+        并做精度转换、推理模式设置与内存报告（Jittor 版本）
+        """
         if self.model is None:
+            from utils.load_models_tokenizers import load_mask_filling_model
             try:
                 print(f"加载掩码填充模型: {self.model_name}")
-                self.model = T5ForConditionalGeneration.from_pretrained(self.model_name)
-                # Jittor 无需 to(device)，自动适配
-                self.model.eval()
+                config = self.config if self.config is not None else {}
+                load_mask_filling_model(self._loader_args(), config)
+                if config["mask_filler"] is not self:
+                    # 未登记在共享表中的填充器：使用共享填充器加载好的同一个模型
+                    self.attach(config["mask_model"])
             except Exception as e:
                 print(f"❌ 加载掩码填充模型失败: {e}")
                 raise
 
-    def replace_masks(self, texts):
-        """替换文本中的掩码标记并返回填充后的文本（Jittor 版本）"""
+    def attach(self, model, tokenizer=None):
+        """使用外部已加载的模型（如 load_mask_filling_model 经模型注册表加载的模型）"""
+        self.model = model
+        if tokenizer is not None:
+            self.tokenizer = tokenizer
+
+    def warm_up(self):
+        """加载模型并做一次填充，使首批文本不再承担加载与算子编译的开销"""
+        self.load_model()
+        if not self.warmed_up:
+            try:
+                self.replace_masks(["warm up <extra_id_0> ."])
+            except Exception as e:
+                print(f"⚠️ 掩码填充器预热失败: {e}")
+            self.warmed_up = True
+        return self
+
+    def _generate_fills(self, texts, span_length=2):
+        """
+        对一批掩码文本做一次padding + 一次generate，返回未跳过特殊token的原始输出；
+        生成长度由掩码数与 span_length 决定，每行输出最后一个哨兵后即停止
+        """
+        pad_token_id = self.tokenizer.pad_token_id
+        if hasattr(self.tokenizer, "batch_encode"):
+            # 向量化分词，直接散射到padding矩阵
+            ids, offsets = self.tokenizer.batch_encode(texts, truncation=True, max_length=512)
+            lengths = np.diff(offsets)
+            input_ids = np.full((len(texts), max(1, int(lengths.max(initial=0)))), pad_token_id, dtype=np.int32)
+            rows = np.repeat(np.arange(len(texts)), lengths)
+            input_ids[rows, np.arange(ids.size) - np.repeat(offsets[:-1], lengths)] = ids
+        else:
+            sequences = [
+                self.tokenizer.encode(text, truncation=True, max_length=512) or [pad_token_id]
+                for text in texts
+            ]
+            max_len = max(len(seq) for seq in sequences)
+            input_ids = [seq + [pad_token_id] * (max_len - len(seq)) for seq in sequences]
+
+        with jt.no_grad():
+            n_masks = count_masks(texts)
+            outputs = self.model.generate(
+                jt.array(input_ids),
+                max_length=fill_length(max(n_masks), span_length),
+                num_return_sequences=1,
+                do_sample=False,
+                eos_token_id=self.tokenizer.eos_token_id,
+                stop_token_ids=sentinel_ids(self.tokenizer, n_masks)
+            )
+        return self.tokenizer.batch_decode(outputs, skip_special_tokens=False)
+
+    def fill_masks(self, texts, span_length=2):
+        """整批掩码文本只调用一次generate并写回各哨兵的填充（失败时抛出异常，由调用方兜底）"""
+        self.load_model()
+        return apply_extracted_fills(texts, extract_fills(self._generate_fills(texts, span_length)))
+
+    def replace_masks(self, texts, span_length=2):
+        """
+        替换文本中的掩码标记并返回填充后的文本（Jittor 版本）
+        每个文本的全部 <extra_id_k> 由一次T5输出同时填充，
+        多个文本按 batch_size 组成一个batch共用一次generate；span_length 为每个掩码的词数
+        """
         self.load_model()
         replaced_texts = []
 
-        for text in texts:
-            current_text = text
-            masks = re.findall(r'<extra_id_\d+>', current_text)
-
-            if masks:
-                # 逐个替换掩码
-                for mask in masks:
-                    # 构建输入文本
-                    input_text = current_text.replace(mask, "<extra_id>")
-                    try:
-                        inputs = self.tokenizer.encode(
-                            input_text,
-                            return_tensors="jt",  # 返回 Jittor 张量
-                            truncation=True,
-                            max_length=512
-                        )
-
-                        # 生成替换内容（Jittor 模型生成）
-                        with jt.no_grad():
-                            outputs = self.model.generate(
-                                inputs,
-                                max_length=512,
-                                num_return_sequences=1,
-                                do_sample=False
-                            )
-
-                        replacement = self.tokenizer.decode(
-                            outputs[0],
-                            skip_special_tokens=True
-                        ).strip()
-                        current_text = current_text.replace(mask, replacement, 1)
-                    except Exception as e:
-                        print(f"❌ 替换掩码 {mask} 失败: {e}")
-                        current_text = current_text.replace(mask, "", 1)  # 移除无法替换的掩码
-
-            replaced_texts.append(current_text)
+        for start in range(0, len(texts), self.batch_size):
+            batch = texts[start:start + self.batch_size]
+            try:
+                outputs = self._generate_fills(batch, span_length)
+                fills = extract_fills(outputs)
+            except Exception as e:
+                print(f"❌ 批量填充掩码失败: {e}")
+                fills = [[] for _ in batch]  # 移除无法替换的掩码
+
+            n_missing = sum(max(0, n - len(f)) for n, f in zip(count_masks(batch), fills))
+            if n_missing:
+                print(f"⚠️ {n_missing} 个掩码未生成对应填充，已移除")
+            replaced_texts.extend(apply_extracted_fills(batch, fills))
 
         return replaced_texts
 
 
-def perturb_texts(texts, pct=0.3, span_length=2, model_name="t5-small", tokenizer=None, device="cpu"):
+# 进程级共享的掩码填充器：(模型名称, 权重精度) -> MaskFiller，批处理任务只付一次加载代价
+_MASK_FILLERS = {}
+
+
+def get_mask_filler(model_name="t5-small", precision="fp32", tokenizer=None, device="cpu", batch_size=16):
+    """取共享的 MaskFiller（首次调用时创建，模型仍在首次填充或 warm_up 时才加载）"""
+    key = ModelRegistry.make_key(model_name, precision)
+    if key not in _MASK_FILLERS:
+        _MASK_FILLERS[key] = MaskFiller(model_name, tokenizer, device, batch_size, precision=precision)
+    return _MASK_FILLERS[key]
+
+
+def warm_up_mask_filler(model_name="t5-small", precision="fp32", **kwargs):
+    """预先加载并预热共享的 MaskFiller"""
+    return get_mask_filler(model_name, precision, **kwargs).warm_up()
+
+
+def release_mask_filler(model_name=None, precision=None, registry=None):
+    """
+    释放共享的 MaskFiller（不指定模型名称 / 精度时匹配全部），返回释放的个数；
+    传入 registry（config["model_registry"]）时同时移出模型注册表，使模型内存真正可回收
+    """
+    released = 0
+    for key in list(_MASK_FILLERS):
+        filler = _MASK_FILLERS[key]
+        if model_name not in (None, filler.model_name) or precision not in (None, filler.precision):
+            continue
+        del _MASK_FILLERS[key]
+        if registry is not None:
+            registry.release(key)
+        released += 1
+    if released:
+        print(f"🗑️ 已释放 {released} 个共享掩码填充器")
+    return released
+
+
+# perturb_texts 未指定轮次时的调用计数：同一进程内重复调用得到新的掩码，整个调用序列仍可复现
+_PERTURB_ROUNDS = itertools.count()
+
+
+def perturb_texts(texts, pct=0.3, span_length=2, model_name="t5-small", tokenizer=None, device="cpu", seed=0,
+                  precision="fp32", round_idx=None):
     """
     扰动文本：随机替换部分文本为掩码，再用模型填充（Jittor 版本）
 
@@ -90,6 +333,9 @@ def perturb_texts(texts, pct=0.3, span_length=2, model_name="t5-small", tokenize
         model_name: 掩码填充模型名称
         tokenizer: 分词器（可选）
         device: 运行设备（Jittor 中仅兼容）
+        seed: 掩码种子（同一文本、同一种子、同一轮次得到相同的掩码）
+        round_idx: 扰动轮次（为 None 时每次调用自动递增，重复调用得到不同的扰动）
+        precision: 掩码模型权重精度（与模型名称一起决定共享的 MaskFiller）
 
     返回:
         扰动后的文本列表
@@ -99,43 +345,45 @@ def perturb_texts(texts, pct=0.3, span_length=2, model_name="t5-small", tokenize
         return []
 
     print(f"扰动 {len(texts)} 个文本，掩码比例: {pct}, 跨度长度: {span_length}")
-    mask_filler = MaskFiller(model_name, tokenizer, device)
-    perturbed_texts = []
+    mask_filler = get_mask_filler(model_name, precision, tokenizer, device)
+    perturbed_texts = [None] * len(texts)
+    masked_texts, masked_indices = [], []
+    words_list = [text.split() for text in texts]
 
-    for text in texts:
-        words = text.split()
+    for idx, (text, words) in enumerate(zip(texts, words_list)):
         if len(words) <= span_length:
             # 文本过短，直接添加后缀作为扰动
             perturbed = text + " [扰动]" if not text.endswith(" ") else text[:-1] + "[扰动]"
-            perturbed_texts.append(perturbed)
+            perturbed_texts[idx] = perturbed
             continue
+        masked_indices.append(idx)
 
-        # 计算需要掩码的数量
-        n_masks = max(1, int(len(words) * pct))
-        masked_words = words.copy()
-
-        # 插入掩码
-        for i in range(n_masks):
-            mask_token = f"<extra_id_{i}>"
-            # 随机选择插入位置（避免首尾）
-            insert_pos = random.randint(1, len(masked_words) - 1)
-            masked_words.insert(insert_pos, mask_token)
+    # 全部文本的掩码跨度一次采样，每段被掩码的词替换为一个哨兵
+    if round_idx is None:
+        round_idx = next(_PERTURB_ROUNDS)
+    if masked_indices:
+        masks = sample_span_masks(
+            [len(words_list[idx]) for idx in masked_indices], pct, span_length,
+            mask_seeds([texts[idx] for idx in masked_indices], [round_idx] * len(masked_indices), seed)
+        )
+        masked_texts = [join_masked(words_list[idx], mask) for idx, mask in zip(masked_indices, masks)]
 
-        masked_text = " ".join(masked_words)
+    # 全部掩码文本一次性批量填充
+    try:
+        filled_texts = mask_filler.replace_masks(masked_texts, span_length) if masked_texts else []
+    except Exception as e:
+        print(f"❌ 处理文本时出错: {e}")
+        filled_texts = []
 
-        # 替换掩码
-        try:
-            filled_texts = mask_filler.replace_masks([masked_text])
-            perturbed_text = filled_texts[0] if filled_texts else text
-        except Exception as e:
-            print(f"❌ 处理文本时出错: {e}")
-            perturbed_text = text
+    for pos, idx in enumerate(masked_indices):
+        text = texts[idx]
+        perturbed_text = filled_texts[pos] if pos < len(filled_texts) else text
 
         # 确保扰动后文本与原始不同
         if perturbed_text == text:
             perturbed_text = text + " " if not text.endswith(" ") else text[:-1]
 
-        perturbed_texts.append(perturbed_text)
+        perturbed_texts[idx] = perturbed_text
 
     return perturbed_texts
 
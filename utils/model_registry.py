@@ -0,0 +1,70 @@
+# model_registry.py
+# 模型注册表：按 (模型名称, 权重精度) 常驻内存，超出内存预算时按LRU淘汰，切换评分模型无需重新加载
+from collections import OrderedDict
+
+from .precision import model_memory_bytes
+
+
+class ModelRegistry:
+    """
+    常驻模型的LRU注册表
+    get_or_load 命中时直接返回已加载的 (model, tokenizer)，未命中时调用 loader 加载并登记；
+    所有常驻模型的参数总字节数超过 memory_budget 时，淘汰最久未使用的模型（刚加载的模型除外）
+    """
+
+    def __init__(self, memory_budget_mb=4096):
+        self.memory_budget = int(memory_budget_mb * 2 ** 20) if memory_budget_mb else None
+        self.entries = OrderedDict()  # key -> (model, tokenizer, 字节数)
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(model_name, precision):
+        return f"{model_name}|{precision}"
+
+    @property
+    def resident_bytes(self):
+        return sum(entry[2] for entry in self.entries.values())
+
+    def get_or_load(self, key, loader):
+        """返回 (model, tokenizer)；loader() 返回 (model, tokenizer)"""
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            model, tokenizer, _ = self.entries[key]
+            print(f"♻️ 模型注册表命中: {key}")
+            return model, tokenizer
+
+        model, tokenizer = loader()
+        self.loads += 1
+        self.entries[key] = (model, tokenizer, model_memory_bytes(model))
+        self._evict(keep=key)
+        return model, tokenizer
+
+    def _evict(self, keep):
+        if self.memory_budget is None:
+            return
+        while self.resident_bytes > self.memory_budget and len(self.entries) > 1:
+            key = next(k for k in self.entries if k != keep)
+            _, _, n_bytes = self.entries.pop(key)
+            self.evictions += 1
+            print(f"🗑️ 模型注册表超出预算，淘汰 {key}（{n_bytes / 2 ** 20:.1f}MB）")
+
+    def release(self, key):
+        """主动移除某个模型"""
+        self.entries.pop(key, None)
+
+    def stats(self):
+        return {
+            "resident": list(self.entries),
+            "resident_mb": self.resident_bytes / 2 ** 20,
+            "hits": self.hits,
+            "loads": self.loads,
+            "evictions": self.evictions,
+        }
+
+    def report(self):
+        stats = self.stats()
+        print(f"📦 模型注册表: 常驻 {len(stats['resident'])} 个（{stats['resident_mb']:.1f}MB），"
+              f"命中 {stats['hits']} 次，加载 {stats['loads']} 次，淘汰 {stats['evictions']} 次")
@@ -0,0 +1,137 @@
+# precision.py
+# 低精度权重模式：fp16/bf16 存储 + fp32 计算，Linear 层逐输出通道 int8 量化
+import copy
+
+import numpy as np
+import jittor as jt
+
+# 各数据类型每个元素的字节数（用于统计权重内存占用）
+DTYPE_BYTES = {"float64": 8, "float32": 4, "float16": 2, "bfloat16": 2, "int64": 8, "int32": 4, "int8": 1, "uint8": 1}
+
+
+def get_precision_mode(args):
+    """由 --int8 / --half / --half_dtype 得到权重精度模式：int8 / fp16 / bf16 / fp32"""
+    if getattr(args, "int8", False):
+        return "int8"
+    if getattr(args, "half", False):
+        return "bf16" if getattr(args, "half_dtype", "float16") == "bfloat16" else "fp16"
+    return "fp32"
+
+
+def model_memory_bytes(model):
+    """模型参数（含低精度存储的权重）的内存占用字节数"""
+    if not hasattr(model, "parameters"):
+        return 0
+    return int(sum(p.numel() * DTYPE_BYTES.get(str(p.dtype), 4) for p in model.parameters()))
+
+
+def _to_half(var, mode):
+    return var.bfloat16() if mode == "bf16" else var.float16()
+
+
+class HalfLinear(jt.Module):
+    """权重以 fp16/bf16 存储，前向时转回 fp32 计算（fp32 累加）"""
+
+    def __init__(self, linear, mode="fp16"):
+        self.weight_storage = _to_half(linear.weight, mode).stop_grad()
+        self.bias = linear.bias.float32().stop_grad() if getattr(linear, "bias", None) is not None else None
+
+    @property
+    def weight(self):
+        return self.weight_storage.float32()
+
+    def execute(self, x):
+        out = jt.nn.matmul_transpose(x, self.weight)
+        return out + self.bias if self.bias is not None else out
+
+
+class Int8Linear(jt.Module):
+    """逐输出通道对称 int8 量化：weight ≈ weight_int8 * scale[:, None]，前向时反量化为 fp32 计算"""
+
+    def __init__(self, linear):
+        weight = linear.weight.numpy().astype(np.float32)
+        scale = np.abs(weight).max(axis=1) / 127.0
+        scale[scale == 0] = 1.0
+        self.weight_int8 = jt.array(np.clip(np.round(weight / scale[:, None]), -127, 127).astype(np.int8)).stop_grad()
+        self.scale = jt.array(scale.astype(np.float32)).stop_grad()
+        self.bias = linear.bias.float32().stop_grad() if getattr(linear, "bias", None) is not None else None
+
+    @property
+    def weight(self):
+        return self.weight_int8.float32() * self.scale.unsqueeze(1)
+
+    def execute(self, x):
+        out = jt.nn.matmul_transpose(x, self.weight)
+        return out + self.bias if self.bias is not None else out
+
+
+class HalfEmbedding(jt.Module):
+    """词向量以 fp16/bf16 存储，查表后转回 fp32"""
+
+    def __init__(self, embedding, mode="fp16"):
+        self.weight_storage = _to_half(embedding.weight, mode).stop_grad()
+
+    @property
+    def weight(self):
+        return self.weight_storage.float32()
+
+    def execute(self, x):
+        return self.weight_storage[x].float32()
+
+
+def apply_precision(model, mode):
+    """
+    按精度模式原地替换模型中的 Linear / Embedding 层（包括 lm_head）：
+    fp16/bf16 模式下 Linear 与 Embedding 均以半精度存储；int8 模式下 Linear 逐通道量化
+    子模块先浅拷贝再替换，转换前对模型做的浅拷贝仍指向原fp32层（用作参考模型）
+    返回 (model, 替换的层数)
+    """
+    if mode == "fp32":
+        return model, 0
+
+    n_replaced = 0
+    for name, layer in list(vars(model).items()):
+        if isinstance(layer, jt.nn.Linear):
+            replacement = Int8Linear(layer) if mode == "int8" else HalfLinear(layer, mode)
+            n_layers = 1
+        elif isinstance(layer, jt.nn.Embedding) and mode in ("fp16", "bf16"):
+            replacement, n_layers = HalfEmbedding(layer, mode), 1
+        elif isinstance(layer, jt.Module) and not isinstance(layer, (HalfLinear, Int8Linear, HalfEmbedding)):
+            replacement, n_layers = apply_precision(copy.copy(layer), mode)
+        else:
+            continue
+        if n_layers:
+            setattr(model, name, replacement)
+            n_replaced += n_layers
+    return model, n_replaced
+
+
+def load_with_precision(args, config, model, name):
+    """
+    加载器调用：按 --half / --int8 转换权重，打印并记录内存占用（config["precision"][name]）
+    --precision_reference 时保留转换前的fp32基础模型（config["precision_reference"]["base_model"]），
+    供似然基线报告低精度带来的AUC变化；只有基线实验比较的第一个基础模型保留参考，
+    掩码模型与之后切换的评分模型不保留，比较完成后由 run_baselines 释放
+    """
+    mode = get_precision_mode(args)
+    fp32_bytes = model_memory_bytes(model)
+    if (mode != "fp32" and getattr(args, "precision_reference", False)
+            and name == "base_model" and "precision_reference" not in config):
+        config["precision_reference"] = {name: copy.copy(model)}
+    try:
+        model, n_replaced = apply_precision(model, mode)
+    except Exception as e:
+        print(f"❌ {name} 转换为 {mode} 失败，保持fp32: {str(e)}")
+        mode, n_replaced = "fp32", 0
+
+    report = {
+        "mode": mode,
+        "n_layers_converted": n_replaced,
+        "fp32_bytes": fp32_bytes,
+        "bytes": model_memory_bytes(model),
+    }
+    config.setdefault("precision", {})[name] = report
+    if mode != "fp32":
+        print(f"🧮 {name} 权重精度 {mode}：转换 {n_replaced} 层，内存 "
+              f"{fp32_bytes / 2 ** 20:.1f}MB -> {report['bytes'] / 2 ** 20:.1f}MB")
+    return model
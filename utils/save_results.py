@@ -231,6 +231,15 @@ def save_results(args, config, baseline_outputs, outputs):
     except Exception as e:
         print(f"⚠️ 保存调试数据失败: {e}")
 
+    # 权重精度与内存占用（--half / --int8）
+    if config.get("precision"):
+        try:
+            with open(os.path.join(SAVE_FOLDER, "precision_report.json"), "w") as f:
+                json.dump(config["precision"], f, default=default_serializer, indent=2)
+            print("✅ 保存precision_report.json成功")
+        except Exception as e:
+            print(f"❌ 保存precision_report.json失败: {str(e)}")
+
     if not args.skip_baselines:
         try:
             with open(os.path.join(SAVE_FOLDER, f"likelihood_threshold_results.json"), "w") as f:
@@ -239,56 +248,36 @@ def save_results(args, config, baseline_outputs, outputs):
         except Exception as e:
             print(f"❌ 保存likelihood_threshold_results.json失败: {str(e)}")
 
-        if args.openai_model is None:
-            if len(baseline_outputs) >= 2:
-                try:
-                    with open(os.path.join(SAVE_FOLDER, f"rank_threshold_results.json"), "w") as f:
-                        json.dump(baseline_outputs[1], f, default=default_serializer, indent=2)
-                    print("✅ 保存rank_threshold_results.json成功")
-                except Exception as e:
-                    print(f"❌ 保存rank_threshold_results.json失败: {str(e)}")
-            else:
-                print("⚠️ baseline_outputs数据不足，跳过rank_threshold_results保存")
-
-            if len(baseline_outputs) >= 3:
+        if not getattr(args, 'openai_model', None):
+            # 按实验名称查找（基线列表的顺序随启用的实验而变化）
+            for name in ("rank", "logrank", "entropy"):
+                experiment = next(
+                    (output for output in baseline_outputs if output.get("name") == f"{name}_threshold"), None
+                )
+                if experiment is None:
+                    print(f"⚠️ baseline_outputs中没有{name}实验，跳过{name}_threshold_results保存")
+                    continue
                 try:
-                    with open(os.path.join(SAVE_FOLDER, f"logrank_threshold_results.json"), "w") as f:
-                        json.dump(baseline_outputs[2], f, default=default_serializer, indent=2)
-                    print("✅ 保存logrank_threshold_results.json成功")
+                    with open(os.path.join(SAVE_FOLDER, f"{name}_threshold_results.json"), "w") as f:
+                        json.dump(experiment, f, default=default_serializer, indent=2)
+                    print(f"✅ 保存{name}_threshold_results.json成功")
                 except Exception as e:
-                    print(f"❌ 保存logrank_threshold_results.json失败: {str(e)}")
-            else:
-                print("⚠️ baseline_outputs数据不足，跳过logrank_threshold_results保存")
-
-            if len(baseline_outputs) >= 4:
-                try:
-                    with open(os.path.join(SAVE_FOLDER, f"entropy_threshold_results.json"), "w") as f:
-                        json.dump(baseline_outputs[3], f, default=default_serializer, indent=2)
-                    print("✅ 保存entropy_threshold_results.json成功")
-                except Exception as e:
-                    print(f"❌ 保存entropy_threshold_results.json失败: {str(e)}")
-            else:
-                print("⚠️ baseline_outputs数据不足，跳过entropy_threshold_results保存")
-
-        if len(baseline_outputs) >= 5:
-            try:
-                with open(os.path.join(SAVE_FOLDER, f"roberta-base-openai-detector_results.json"), "w") as f:
-                    json.dump(baseline_outputs[-2], f, default=default_serializer, indent=2)
-                print("✅ 保存roberta-base-openai-detector_results.json成功")
-            except Exception as e:
-                print(f"❌ 保存roberta-base-openai-detector_results.json失败: {str(e)}")
-        else:
-            print("⚠️ baseline_outputs数据不足，跳过roberta-base-openai-detector保存")
-
-        if len(baseline_outputs) >= 6:
+                    print(f"❌ 保存{name}_threshold_results.json失败: {str(e)}")
+
+        # RoBERTa 检测器结果同样按名称查找，未运行时不写文件
+        for name in ("roberta-base-openai-detector", "roberta-large-openai-detector"):
+            experiment = next(
+                (output for output in list(baseline_outputs) + list(outputs or []) if output.get("name") == name), None
+            )
+            if experiment is None:
+                print(f"⚠️ 没有{name}实验结果，跳过{name}_results保存")
+                continue
             try:
-                with open(os.path.join(SAVE_FOLDER, f"roberta-large-openai-detector_results.json"), "w") as f:
-                    json.dump(baseline_outputs[-1], f, default=default_serializer, indent=2)
-                print("✅ 保存roberta-large-openai-detector_results.json成功")
+                with open(os.path.join(SAVE_FOLDER, f"{name}_results.json"), "w") as f:
+                    json.dump(experiment, f, default=default_serializer, indent=2)
+                print(f"✅ 保存{name}_results.json成功")
             except Exception as e:
-                print(f"❌ 保存roberta-large-openai-detector_results.json失败: {str(e)}")
-        else:
-            print("⚠️ baseline_outputs数据不足，跳过roberta-large-openai-detector保存")
+                print(f"❌ 保存{name}_results.json失败: {str(e)}")
 
     # 保存ROC曲线和其他可视化结果
     try:
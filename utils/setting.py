@@ -2,6 +2,10 @@ import os
 import json
 import datetime
 
+from .cache import LLCache, PerturbationBank, TokenCache
+from .precision import get_precision_mode
+from .model_registry import ModelRegistry
+
 
 def initial_setup(args, config):
     API_TOKEN_COUNTER = 0  # 保留该变量，保持config兼容性，无实际OpenAI用途
@@ -17,10 +21,8 @@ def initial_setup(args, config):
 
     # define SAVE_FOLDER as the timestamp - base model name - mask filling model name
     # create it if it doesn't exist
-    # 补充：若args无int8/half属性，兜底赋值，避免属性不存在报错
-    int8_flag = args.int8 if hasattr(args, 'int8') else False
-    half_flag = args.half if hasattr(args, 'half') else False
-    precision_string = "int8" if int8_flag else ("fp16" if half_flag else "fp32")
+    # 权重精度（--int8 / --half，缺省为fp32）
+    precision_string = get_precision_mode(args)
 
     # 补充：若args无do_top_k/do_top_p属性，兜底赋值，避免属性不存在报错
     do_top_k_flag = args.do_top_k if hasattr(args, 'do_top_k') else False
@@ -94,4 +96,21 @@ def set_experiment_config(args, config):
     config["n_perturbation_list"] = [int(x) for x in n_perturbation_list.split(",")]
     config["n_perturbation_rounds"] = n_perturbation_rounds
     config["n_similarity_samples"] = n_similarity_samples
-    config["cache_dir"] = cache_dir
\ No newline at end of file
+    config["cache_dir"] = cache_dir
+
+    # 对数似然缓存（内存LRU + cache_dir 下的磁盘层），可用 --no_ll_cache 关闭
+    no_ll_cache = args.no_ll_cache if hasattr(args, 'no_ll_cache') else False
+    ll_cache_size = args.ll_cache_size if hasattr(args, 'll_cache_size') else 100000
+    config["ll_cache"] = None if no_ll_cache else LLCache(cache_dir, max_entries=ll_cache_size)
+
+    # 分词缓存（各处分词共用，--token_cache_mb 为内存上限，0 表示关闭）
+    token_cache_mb = args.token_cache_mb if hasattr(args, 'token_cache_mb') else 256
+    config["token_cache"] = TokenCache(token_cache_mb) if token_cache_mb else None
+
+    # 常驻模型注册表（按模型名称 + 权重精度，超出内存预算时LRU淘汰）
+    model_memory_budget = args.model_memory_budget if hasattr(args, 'model_memory_budget') else 4096
+    config["model_registry"] = ModelRegistry(model_memory_budget)
+
+    # 持久化扰动库（cache_dir 下追加写入），可用 --no_perturbation_bank 关闭
+    no_perturbation_bank = args.no_perturbation_bank if hasattr(args, 'no_perturbation_bank') else False
+    config["perturbation_bank"] = None if no_perturbation_bank else PerturbationBank(cache_dir)
\ No newline at end of file
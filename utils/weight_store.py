@@ -0,0 +1,177 @@
+# weight_store.py
+# 内存映射权重格式：固定头 + JSON索引 + 按64字节对齐的连续张量，numpy.memmap 直接映射到页缓存
+# 同一主机上的多个进程共享同一份页缓存，冷启动不再先把整个权重文件读入内存（参数仍由 Jittor 拷贝到自己的内存中）
+import os
+import sys
+import json
+import time
+import struct
+
+import numpy as np
+
+MAGIC = b"JTWSTORE"
+VERSION = 1
+ALIGNMENT = 64
+# 头部：魔数(8字节) + 版本(uint32) + 索引长度(uint64)
+HEADER_FORMAT = "<8sIQ"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def store_path(cache_dir, model_id):
+    """cache_dir 下某个模型的权重文件路径"""
+    return os.path.join(cache_dir, "weights", f"{model_id.replace('/', '_')}.jtw")
+
+
+def _to_numpy(value):
+    return value.numpy() if hasattr(value, "numpy") else np.asarray(value)
+
+
+def save_weights(state_dict, path):
+    """
+    将 {参数名: 数组} 写为权重文件：先写索引，再按对齐偏移依次写入各张量
+    先写临时文件再原子替换，避免其他进程映射到写了一半的文件
+    """
+    arrays = {name: np.ascontiguousarray(_to_numpy(value)) for name, value in state_dict.items()}
+
+    entries, offset = [], 0
+    for name, array in arrays.items():
+        offset = _align(offset)
+        entries.append({"name": name, "dtype": array.dtype.str, "shape": list(array.shape),
+                        "offset": offset, "nbytes": int(array.nbytes)})
+        offset += array.nbytes
+    index = json.dumps({"tensors": entries}).encode("utf-8")
+    data_start = _align(HEADER_SIZE + len(index))
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, len(index)))
+        f.write(index)
+        for entry in entries:
+            f.seek(data_start + entry["offset"])
+            f.write(arrays[entry["name"]].tobytes())
+    os.replace(tmp_path, path)
+    return data_start + offset
+
+
+def open_weights(path):
+    """内存映射权重文件，返回 {参数名: 只读 np.memmap}（不读取张量数据）"""
+    with open(path, "rb") as f:
+        magic, version, index_size = struct.unpack(HEADER_FORMAT, f.read(HEADER_SIZE))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"不是有效的权重文件: {path}")
+        index = json.loads(f.read(index_size).decode("utf-8"))
+    data_start = _align(HEADER_SIZE + index_size)
+
+    tensors = {}
+    for entry in index["tensors"]:
+        tensors[entry["name"]] = np.memmap(
+            path, dtype=np.dtype(entry["dtype"]), mode="r",
+            offset=data_start + entry["offset"], shape=tuple(entry["shape"])
+        )
+    return tensors
+
+
+def load_weights(model, path):
+    """
+    从权重文件加载模型参数：张量以 memmap 视图交给 load_parameters，省去先把整个文件读入内存的一份主机拷贝；
+    load_parameters 仍会把数据拷贝进 Jittor 自己分配的参数内存，因此每个进程各持有一份参数
+    """
+    tensors = open_weights(path)
+    missing = [name for name in model.state_dict() if name not in tensors]
+    if missing:
+        raise ValueError(f"权重文件缺少 {len(missing)} 个参数，例如 {missing[0]}")
+    # Jittor 不接受 np.memmap 类型，转为同一映射内存上的 ndarray 视图（视图本身不拷贝）
+    model.load_parameters({name: array.view(np.ndarray) for name, array in tensors.items()})
+    return model
+
+
+def load_or_create(config, model, model_id):
+    """
+    有对应权重文件时从 cache_dir 映射加载；否则把当前（随机初始化的）权重写入权重文件，
+    之后的运行与其他进程加载同一组权重
+    """
+    path = store_path(config.get("cache_dir", "./cache"), model_id)
+    try:
+        if os.path.exists(path):
+            start = time.time()
+            load_weights(model, path)
+            print(f"📦 从权重文件加载 {model_id}: {path}（{time.time() - start:.2f}s）")
+        else:
+            size = save_weights(model.state_dict(), path)
+            print(f"📦 已写入权重文件 {model_id}: {path}（{size / 2 ** 20:.1f}MB）")
+    except Exception as e:
+        print(f"⚠️ 权重文件读写失败，使用当前权重: {str(e)}")
+    return model
+
+
+def ensure_weights(config, model_id, factory):
+    """
+    保证 cache_dir 下有该模型的权重文件：不存在时用 factory() 构造模型并写入（模型随即释放），
+    之后各进程从同一文件加载，得到完全相同的权重
+    """
+    path = store_path(config.get("cache_dir", "./cache"), model_id)
+    if not os.path.exists(path):
+        size = save_weights(factory().state_dict(), path)
+        print(f"📦 已写入权重文件 {model_id}: {path}（{size / 2 ** 20:.1f}MB）")
+    return path
+
+
+def convert_checkpoint(src, dst):
+    """
+    转换器：将 .npz / Jittor(.pkl) 检查点转换为权重文件
+    """
+    if src.endswith(".npz"):
+        with np.load(src) as checkpoint:
+            state_dict = {name: checkpoint[name] for name in checkpoint.files}
+    else:
+        import jittor as jt
+        state_dict = jt.load(src)
+    size = save_weights(state_dict, dst)
+    print(f"✅ 已转换 {len(state_dict)} 个张量: {src} -> {dst}（{size / 2 ** 20:.1f}MB）")
+    return dst
+
+
+def benchmark_load(path, repeats=3):
+    """
+    加载耗时对比：memmap 映射（只读索引）/ memmap 全部读入 / np.fromfile 整体读入再切分
+    """
+    results = {"memmap_open": [], "memmap_touch": [], "read_copy": []}
+    for _ in range(repeats):
+        start = time.time()
+        tensors = open_weights(path)
+        results["memmap_open"].append(time.time() - start)
+
+        start = time.time()
+        for array in tensors.values():
+            np.asarray(array).sum()
+        results["memmap_touch"].append(time.time() - start)
+        del tensors
+
+        start = time.time()
+        raw = np.fromfile(path, dtype=np.uint8)
+        for array in open_weights(path).values():
+            raw[array.offset:array.offset + array.nbytes].copy()
+        results["read_copy"].append(time.time() - start)
+        del raw
+
+    summary = {name: float(np.median(times)) for name, times in results.items()}
+    print(f"⏱️ 权重加载基准（{os.path.getsize(path) / 2 ** 20:.1f}MB，{repeats} 次中位数）: "
+          f"映射 {summary['memmap_open'] * 1000:.1f}ms，映射+读取 {summary['memmap_touch'] * 1000:.1f}ms，"
+          f"整体读入+拷贝 {summary['read_copy'] * 1000:.1f}ms")
+    return summary
+
+
+if __name__ == "__main__":
+    # python -m utils.weight_store convert <检查点> <权重文件>
+    # python -m utils.weight_store benchmark <权重文件>
+    if len(sys.argv) >= 4 and sys.argv[1] == "convert":
+        convert_checkpoint(sys.argv[2], sys.argv[3])
+    elif len(sys.argv) >= 3 and sys.argv[1] == "benchmark":
+        benchmark_load(sys.argv[2])
+    else:
+        print("用法: python -m utils.weight_store convert <src.npz|src.pkl> <dst.jtw> | benchmark <file.jtw>")